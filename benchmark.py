@@ -0,0 +1,359 @@
+# Microbenchmarks of the output monitoring pipeline
+#
+# Measures fileReader + infoliLineProcessor on synthetic InferiorOlive output files
+# and stdoutMonitor.scan_stdout (through checkpointMonitor) on synthetic RCCE stdout.
+# Every combination of the cell and core counts is run once, and the results are
+# printed as JSON so that they can be compared between revisions.
+#
+# usage: python benchmark.py [--cells 2304,9216] [--cores 8,48] [--rate 0] [--output results.json]
+
+import os
+import json
+import shutil
+import tempfile
+import platform
+import logging
+from optparse import OptionParser
+from threading import Thread
+from time import time, sleep
+
+import infoli_diagnostics
+from monitors import fileReader, checkpointMonitor
+from infoli_diagnostics import infoliLineProcessor
+from stats import streamingStats
+
+try:
+    clock_ticks = float(os.sysconf('SC_CLK_TCK'))
+except (ValueError, OSError, AttributeError):
+    clock_ticks = None
+
+
+def thread_ids():
+    ''' Returns the kernel ids of the threads of the process, or an empty set
+        where /proc is not available
+    '''
+    try:
+        return set(os.listdir('/proc/self/task'))
+    except OSError:
+        return set()
+
+
+def thread_cpu_time(tid):
+    ''' Returns the user and system CPU time of a thread in seconds, or None '''
+    if tid is None or clock_ticks is None:
+        return None
+    try:
+        with open('/proc/self/task/%s/stat' % tid, 'r') as f:
+            fields = f.read().rsplit(')', 1)[1].split()
+    except (IOError, OSError, IndexError):
+        return None
+    return (int(fields[11]) + int(fields[12])) / clock_ticks
+
+
+def cpu_since(tid, before):
+    ''' Returns the CPU time of a thread since before, or None if it is not known '''
+    after = thread_cpu_time(tid)
+    if before is None or after is None:
+        return None
+    return after - before
+
+
+def percentile(values, p):
+    ''' Nearest-rank percentile of a sorted list '''
+    if len(values) == 0:
+        return None
+    return values[min(int(p / 100.0 * len(values)), len(values) - 1)]
+
+
+def latency_summary(latencies):
+    latencies = sorted(latencies)
+    if len(latencies) == 0:
+        return None
+    return {
+        'mean': sum(latencies) / len(latencies),
+        'p50': percentile(latencies, 50),
+        'p99': percentile(latencies, 99),
+        'max': latencies[-1],
+    }
+
+
+class pacedWriter(object):
+    ''' Writes the lines produced by make_line(i) to a file object, lines_per_write
+        lines at a time. With a rate of lines per second the writes follow a fixed
+        schedule, otherwise they are issued back to back. The write time of every
+        line is recorded
+    '''
+
+    def __init__(self, f, make_line, count, rate, lines_per_write):
+        self.f = f
+        self.make_line = make_line
+        self.count = count
+        self.rate = rate
+        self.lines_per_write = lines_per_write
+        self.written = [None] * count
+        self.bytes = 0
+        self.t = Thread(target=self.write)
+        self.t.daemon = True
+
+    def start(self):
+        self.t.start()
+
+    def write(self):
+        start = time()
+        for first in range(0, self.count, self.lines_per_write):
+            if self.rate:
+                delay = start + first / float(self.rate) - time()
+                if delay > 0:
+                    sleep(delay)
+            last = min(first + self.lines_per_write, self.count)
+            text = ''.join(self.make_line(i) for i in range(first, last))
+            now = time()    # before writing, so that readers never see lines without one
+            for i in range(first, last):
+                self.written[i] = now
+            self.f.write(text)
+            self.f.flush()
+            self.bytes += len(text)
+
+    def join(self):
+        self.t.join()
+
+
+class benchDiagnostic(object):
+    ''' Stands in for infoliOutputDivergence: provides the cell count and counts failures '''
+
+    def __init__(self, cellcount):
+        self.manager = self
+        self.cellcount = cellcount
+        self.failures = 0
+
+    def fail(self):
+        self.failures += 1
+
+    def reader_completed(self):
+        pass
+
+
+class timedLineProcessor(infoliLineProcessor):
+    ''' Records when every simstep is validated '''
+
+    def __init__(self, core, diagnostic):
+        infoliLineProcessor.__init__(self, core, diagnostic, 0)
+        self.validated = []     # (simstep, time) pairs, in order
+
+    def step_to(self, simstep):
+        infoliLineProcessor.step_to(self, simstep)
+        self.validated.append((simstep, time()))
+
+    def latencies(self, written):
+        ''' Returns the time from the write of every step to its validation '''
+        result = []
+        j = 0
+        for step, t in enumerate(written, 1):
+            while j < len(self.validated) and self.validated[j][0] < step:
+                j += 1
+            if j == len(self.validated):
+                break
+            result.append(self.validated[j][1] - t)
+        return result
+
+
+def infoli_line(cellcount):
+    voltages = ' '.join(['-60.%06d' % (c * 7919 % 1000000) for c in range(cellcount)])
+    def make_line(i):
+        return '%d %.2f %d %s\n' % (i + 1, (i + 1) * 0.05, cellcount, voltages)
+    return make_line
+
+
+def bench_file_readers(cells, cores, steps, rate, lines_per_write, timeout):
+    ''' Follows one InferiorOlive output file per core, as infoliOutputDivergence does '''
+    cellcount = max(cells / cores, 1)
+    diagnostic = benchDiagnostic(cellcount)
+    directory = tempfile.mkdtemp(prefix='depman-bench')
+    make_line = infoli_line(cellcount)
+    readers, writers, tids = [], [], []
+    try:
+        for core in range(cores):
+            filename = os.path.join(directory, 'InferiorOlive_Output%d.txt' % core)
+            open(filename, 'w').close()
+            before = thread_ids()
+            readers.append(fileReader(filename, timedLineProcessor(core, diagnostic)))
+            new = thread_ids() - before
+            tids.append(new.pop() if len(new) == 1 else None)
+            writers.append(pacedWriter(open(filename, 'a'), make_line, steps, rate, lines_per_write))
+
+        cpu_before = [thread_cpu_time(tid) for tid in tids]
+        start = time()
+        for writer in writers:
+            writer.start()
+        for writer in writers:
+            writer.join()
+        deadline = time() + timeout
+        while time() < deadline and \
+              any(reader.line_processor.simstep < steps for reader in readers):
+            sleep(0.001)
+        elapsed = time() - start
+        cpu = [cpu_since(tid, before) for tid, before in zip(tids, cpu_before)]
+    finally:
+        for reader in readers:
+            reader.wait()
+        for writer in writers:
+            writer.f.close()
+        shutil.rmtree(directory, ignore_errors=True)
+
+    latencies = []
+    for reader, writer in zip(readers, writers):
+        latencies.extend(reader.line_processor.latencies(writer.written))
+    lines = sum(min(reader.line_processor.simstep, steps) for reader in readers)
+    total_bytes = sum(writer.bytes for writer in writers)
+    measured = [c for c in cpu if c is not None]
+    return {
+        'cells': cells,
+        'cores': cores,
+        'cellcount': cellcount,
+        'lines': lines,
+        'complete': lines == steps * cores,
+        'failures': diagnostic.failures,
+        'elapsed': elapsed,
+        'lines_per_sec': lines / elapsed,
+        'bytes_per_sec': total_bytes / elapsed,
+        'latency': latency_summary(latencies),
+        'cpu_per_thread': {
+            'mean': sum(measured) / len(measured),
+            'max': max(measured),
+        } if len(measured) > 0 else None,
+    }
+
+
+class benchManager(object):
+    ''' Stands in for depman in checkpointMonitor '''
+
+    def __init__(self, process, cores):
+        self.simulation = process
+        self.restarted = False
+        self.cores = ['rck' + str(core).zfill(2) for core in range(max(cores, 3))]
+        self.intervals = streamingStats()
+        self.latencies = streamingStats()
+
+
+class pipeProcess(object):
+    ''' A process whose stdout is the read end of a pipe '''
+
+    def __init__(self):
+        r, w = os.pipe()
+        self.stdout = os.fdopen(r, 'r')
+        self.stdin = os.fdopen(w, 'w')
+
+
+class timedCheckpointMonitor(checkpointMonitor):
+    ''' Records when every line is processed '''
+
+    def __init__(self, manager):
+        self.processed = []
+        checkpointMonitor.__init__(self, manager)
+
+    def process_line(self, line):
+        valid = checkpointMonitor.process_line(self, line)
+        self.processed.append(time())
+        return valid
+
+
+def rcce_line(cores):
+    ''' Interleaved stdout of the RCCE ranks, with a checkpoint report every 1000 lines '''
+    def make_line(i):
+        rank = i % cores
+        if i % 1000 == 999:
+            return 'R%d: Checkpoint Interval %f\n' % (rank, 1.5)
+        return 'R%d: simstep %d completed in %f\n' % (rank, i / cores, 0.0021)
+    return make_line
+
+
+def bench_stdout(cores, lines, rate, lines_per_write, timeout):
+    ''' Scans the stdout of a process that interleaves the output of every rank '''
+    process = pipeProcess()
+    before = thread_ids()
+    monitor = timedCheckpointMonitor(benchManager(process, cores))
+    new = thread_ids() - before
+    tid = new.pop() if len(new) == 1 else None
+    writer = pacedWriter(process.stdin, rcce_line(cores), lines, rate, lines_per_write)
+
+    cpu_before = thread_cpu_time(tid)
+    start = time()
+    writer.start()
+    writer.join()
+    deadline = time() + timeout
+    while time() < deadline and len(monitor.processed) < lines:
+        sleep(0.001)
+    elapsed = time() - start
+    cpu = cpu_since(tid, cpu_before)
+    monitor.kill_thread = True
+    process.stdin.close()
+
+    processed = len(monitor.processed)
+    return {
+        'cores': cores,
+        'lines': processed,
+        'complete': processed == lines,
+        'elapsed': elapsed,
+        'lines_per_sec': processed / elapsed,
+        'bytes_per_sec': writer.bytes / elapsed,
+        'latency': latency_summary([p - w for p, w in zip(monitor.processed, writer.written)]),
+        'cpu_per_thread': cpu,
+    }
+
+
+def int_list(option, opt, value, parser):
+    setattr(parser.values, option.dest, [int(x) for x in value.split(',')])
+
+
+def main():
+    parser = OptionParser(usage="usage: %prog [options]")
+    parser.add_option('--cells', type='string', action='callback', callback=int_list,
+                      default=[2304], help="comma separated total cell counts")
+    parser.add_option('--cores', type='string', action='callback', callback=int_list,
+                      default=[8, 48], help="comma separated core counts")
+    parser.add_option('--steps', type='int', default=2000, help="simulation steps written per core")
+    parser.add_option('--stdout-lines', type='int', default=100000, help="lines written to stdout")
+    parser.add_option('--rate', type='float', default=0,
+                      help="lines per second per writer, 0 to write as fast as possible")
+    parser.add_option('--lines-per-write', type='int', default=10)
+    parser.add_option('--timeout', type='float', default=60,
+                      help="time to wait for the monitors after the writers finish")
+    parser.add_option('--no-numpy', action='store_true', help="validate line by line")
+    parser.add_option('--output', help="write the results to a file instead of stdout")
+    options, args = parser.parse_args()
+
+    logging.basicConfig(level=logging.CRITICAL)
+    if options.no_numpy:
+        infoli_diagnostics.numpy = None
+
+    results = {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'numpy': infoli_diagnostics.numpy is not None,
+        'timestamp': time(),
+        'config': {
+            'steps': options.steps,
+            'stdout_lines': options.stdout_lines,
+            'rate': options.rate,
+            'lines_per_write': options.lines_per_write,
+        },
+        'file_readers': [],
+        'stdout': [],
+    }
+    for cells in options.cells:
+        for cores in options.cores:
+            results['file_readers'].append(bench_file_readers(cells, cores, options.steps,
+                                    options.rate, options.lines_per_write, options.timeout))
+    for cores in options.cores:
+        results['stdout'].append(bench_stdout(cores, options.stdout_lines, options.rate,
+                                    options.lines_per_write, options.timeout))
+
+    output = json.dumps(results, indent=2, sort_keys=True)
+    if options.output:
+        with open(options.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print output
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,136 @@
+import os
+import json
+import logging
+from time import time
+from threading import Lock
+
+from config import catalog_file
+
+
+class checkpointCatalog(object):
+    ''' Persistent record of the recovery state of a run: the promoted checkpoints
+        with their files and core set, the TTF observations of the MTTF estimator,
+        the repair times, the chosen checkpoint interval and the checkpoint interval
+        and latency estimates it was chosen from. Every change is appended
+        to a journal of JSON lines and synced to disk before returning, so that a
+        crash loses at most the line being written, which is ignored on loading.
+        Loading replays the journal and compacts it into a single snapshot line.
+        Without a filename, the catalog is only kept in memory
+    '''
+
+    def __init__(self, filename=catalog_file):
+        self.filename = filename
+        self.lock = Lock()
+        self.checkpoints = {}       # step -> record of the promoted checkpoint
+        self.observations = []      # (time, failed) pairs
+        self.mttr_values = []
+        self.interval = None        # checkpoint interval in steps
+        self.estimates = None       # [interval, latency] in seconds, measured every [steps]
+        self.initial_cores = None
+        self.cores = None
+
+    def _append(self, event):
+        if self.filename is None:
+            return
+        with open(self.filename, 'a') as f:
+            f.write(json.dumps(event) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+
+    def _apply(self, event):
+        kind = event['event']
+        if kind == 'snapshot':
+            self.checkpoints = dict((int(step), record) for step, record in event['checkpoints'].items())
+            self.observations = [tuple(o) for o in event['observations']]
+            self.mttr_values = event['mttr']
+            self.interval = event['interval']
+            self.estimates = event.get('estimates')
+            self.initial_cores, self.cores = event['initial_cores'], event['cores']
+        elif kind == 'checkpoint':
+            self.checkpoints[event['step']] = event
+        elif kind == 'delete':
+            self.checkpoints.pop(event['step'], None)
+        elif kind == 'observation':
+            self.observations.append((event['t'], event['failed']))
+        elif kind == 'repair':
+            self.mttr_values.append(event['mttr'])
+        elif kind == 'interval':
+            self.interval = event['steps']
+        elif kind == 'estimates':
+            self.estimates = [event['interval'], event['latency'], event['steps']]
+        elif kind == 'cores':
+            self.initial_cores, self.cores = event['initial_cores'], event['cores']
+
+    def record(self, event, **fields):
+        ''' Applies an event and appends it to the journal '''
+        fields['event'] = event
+        with self.lock:
+            self._apply(fields)
+            self._append(fields)
+
+    def promoted(self, step, files, cores, checksums=None):
+        ''' Records a checkpoint promoted with files, a {name: size} dictionary, and
+            their {name: CRC-32} checksums
+        '''
+        self.record('checkpoint', step=step, files=files, cores=cores, checksums=checksums or {}, time=time())
+
+    def deleted(self, step):
+        self.record('delete', step=step)
+
+    def observed(self, t, failed=True):
+        self.record('observation', t=t, failed=failed)
+
+    def repaired(self, mttr):
+        self.record('repair', mttr=mttr)
+
+    def interval_chosen(self, steps):
+        self.record('interval', steps=steps)
+
+    def estimates_measured(self, interval, latency, steps):
+        ''' Records the checkpoint interval and latency estimates, in seconds, measured
+            while checkpointing every steps simulation steps
+        '''
+        if self.estimates != [interval, latency, steps]:
+            self.record('estimates', interval=interval, latency=latency, steps=steps)
+
+    def cores_changed(self, initial_cores, cores):
+        self.record('cores', initial_cores=initial_cores, cores=cores)
+
+    def load(self):
+        ''' Replays the journal and compacts it. Returns False if there is no journal '''
+        if self.filename is None or not os.path.exists(self.filename):
+            return False
+        with open(self.filename, 'r') as f:
+            for n, line in enumerate(f):
+                try:
+                    event = json.loads(line)
+                except ValueError:
+                    logging.warning("Catalog %s: ignoring the incomplete line %d", self.filename, n + 1)
+                    break
+                self._apply(event)
+        self.compact()
+        logging.info("Catalog loaded: %d checkpoints, %d TTF observations, %d repairs",
+                     len(self.checkpoints), len(self.observations), len(self.mttr_values))
+        return True
+
+    def compact(self):
+        ''' Atomically replaces the journal by a snapshot of the current state '''
+        snapshot = {'event': 'snapshot', 'checkpoints': self.checkpoints, 'observations': self.observations,
+                    'mttr': self.mttr_values, 'interval': self.interval, 'estimates': self.estimates,
+                    'initial_cores': self.initial_cores, 'cores': self.cores}
+        temp = self.filename + '.tmp'
+        with self.lock:
+            with open(temp, 'w') as f:
+                f.write(json.dumps(snapshot) + '\n')
+                f.flush()
+                os.fsync(f.fileno())
+            os.rename(temp, self.filename)
+
+    def newest(self, store):
+        ''' Returns the record of the newest checkpoint whose files are all in store, or None '''
+        for step in sorted(self.checkpoints, reverse=True):
+            record = self.checkpoints[step]
+            if all(store.contains(step, name) for name in record['files']):
+                return record
+            logging.warning("Checkpoint %d of the catalog is incomplete in the store", step)
+        return None
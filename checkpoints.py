@@ -0,0 +1,818 @@
+import os
+import errno
+import fcntl
+import struct
+import logging
+import json
+import shutil
+import hashlib
+import zlib
+import bz2
+import ctypes
+import ctypes.util
+from time import time
+from threading import Lock, Thread, Condition
+from multiprocessing.pool import ThreadPool
+
+from config import checkpoint_threads, safe_location, dedup_checkpoints, store_chunk_size, \
+                   checkpoint_compression, compression_level, compression_threads, checkpoint_checksums
+
+
+class checkpointError(Exception):
+    ''' Raised when a checkpoint file is incomplete or inconsistent '''
+    pass
+
+
+class checksumError(checkpointError):
+    ''' Raised when a stored checkpoint file does not match its checksum '''
+    pass
+
+
+def raise_damaged(errors):
+    ''' Raises the first checksumError of errors, if any '''
+    for error in errors:
+        if isinstance(error, checksumError):
+            raise error
+
+
+class checksumWriter(object):
+    ''' Wraps a file object to compute the CRC-32 of the data written through it '''
+
+    def __init__(self, f):
+        self.f = f
+        self.crc = 0
+
+    def write(self, data):
+        self.crc = zlib.crc32(data, self.crc)
+        self.f.write(data)
+
+    def checksum(self):
+        return self.crc & 0xffffffff
+
+    def verify(self, name, expected):
+        ''' Raises a checksumError if expected is set and differs from the checksum '''
+        if expected is not None and expected != self.checksum():
+            raise checksumError("%s has CRC-32 %08x instead of %08x" % (name, self.checksum(), expected))
+
+
+class checkpointScanner(object):
+    ''' Reads the simulation steps of the infoli checkpoint files from their 12-byte header
+        and 4-byte trailer, seeking over the cell states in between. Files are checked
+        in parallel and the results are cached by (inode, size, mtime), so that
+        unchanged files are never read again
+    '''
+    header = struct.Struct('iii')   # grid rows, grid columns, simulation step
+    trailer = struct.Struct('i')    # simulation step
+
+    def __init__(self, num_threads=checkpoint_threads):
+        self.cache = {}
+        self.lock = Lock()
+        self.pool = ThreadPool(num_threads)
+
+    def steps(self, filename, cellstate_size, cellcount, gridsize):
+        ''' Returns the (header, trailer) simulation steps of a checkpoint file '''
+        st = os.stat(filename)
+        key = (st.st_ino, st.st_size, st.st_mtime, cellstate_size, cellcount, gridsize)
+        with self.lock:
+            cached = self.cache.get(filename)
+        if cached is not None and cached[0] == key:
+            steps, error = cached[1]
+        else:
+            try:
+                steps, error = self._read_steps(filename, st.st_size, cellstate_size, cellcount, gridsize), None
+            except checkpointError as e:
+                steps, error = None, e
+            with self.lock:
+                self.cache[filename] = (key, (steps, error))
+
+        if error is not None:
+            raise error
+        return steps
+
+    def _read_steps(self, filename, size, cellstate_size, cellcount, gridsize):
+        body = cellstate_size * cellcount
+        with open(filename, 'rb') as f:
+            chunk = f.read(self.header.size)
+            if len(chunk) < self.header.size:
+                raise checkpointError("Checkpoint file %s is too short" % filename)
+            rows, columns, header_step = self.header.unpack(chunk)
+            if rows * columns != gridsize:
+                raise checkpointError("Checkpoint file %s contains invalid grid dimensions" % filename)
+            if size < self.header.size + body + self.trailer.size:
+                raise checkpointError("Checkpoint file %s is too short" % filename)
+            f.seek(self.header.size + body)
+            chunk = f.read(self.trailer.size)
+            if len(chunk) < self.trailer.size:
+                raise checkpointError("Checkpoint file %s is too short" % filename)
+        return header_step, self.trailer.unpack(chunk)[0]
+
+    def scan(self, filenames, cellstate_size, cellcount, gridsize):
+        ''' Returns the list of (header, trailer) steps of all files.
+            Raises checkpointError if any of them is invalid
+        '''
+        def scan_file(filename):
+            try:
+                return self.steps(filename, cellstate_size, cellcount, gridsize)
+            except (OSError, IOError) as e:
+                raise checkpointError("Checkpoint file %s could not be read: %s" % (filename, e))
+
+        return self.pool.map(scan_file, filenames)
+
+
+class copyEngine(object):
+    ''' Copies files in process on a bounded thread pool. Every file is cloned through
+        a reflink when the filesystem supports it, or else copied inside the kernel
+        through copy_file_range or sendfile, with a read/write loop as the last resort.
+        Files are written under a temporary name and renamed into place.
+
+        Hard links are never used: the simulator rewrites its checkpoint and output
+        files in place, which would also modify a linked copy.
+
+        Checksummed copies go through the read/write loop, which computes the CRC-32
+        of every file on the way instead of reading it a second time
+    '''
+    FICLONE = 0x40049409
+    block_size = 1 << 20
+    _fallback_errors = (errno.ENOSYS, errno.EXDEV, errno.EINVAL, errno.EOPNOTSUPP, errno.EBADF)
+
+    def __init__(self, num_threads=checkpoint_threads):
+        self.pool = ThreadPool(num_threads)
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self._kernel_copies = []
+        try:
+            copy_file_range = libc.copy_file_range
+            copy_file_range.restype = ctypes.c_ssize_t
+            copy_file_range.argtypes = [ctypes.c_int, ctypes.c_void_p, ctypes.c_int,
+                                        ctypes.c_void_p, ctypes.c_size_t, ctypes.c_uint]
+            self._kernel_copies.append(lambda fin, fout, n: copy_file_range(fin, None, fout, None, n, 0))
+        except AttributeError:
+            pass
+        sendfile = libc.sendfile
+        sendfile.restype = ctypes.c_ssize_t
+        sendfile.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.c_void_p, ctypes.c_size_t]
+        self._kernel_copies.append(lambda fin, fout, n: sendfile(fout, fin, None, n))
+
+    def copy(self, pairs, update=False, checksums=None, expected=None):
+        ''' Copies every (source, destination) pair of paths and returns True if all
+            copies succeeded. With update, destinations that are not older
+            than their source are left untouched, as in cp -u. The CRC-32 of every
+            copied file is added to the checksums dictionary by destination. Once all
+            copies are done, a checksumError is raised if a copy does not match the
+            expected dictionary by source
+        '''
+        t0 = time()
+        results = self.pool.map(lambda pair: self._copy_file(pair[0], pair[1], update, checksums,
+                                                             (expected or {}).get(pair[0])), pairs)
+        elapsed = time() - t0
+
+        total = sum(size for size, error in results if error is None)
+        logging.info("Copied %d files (%d bytes) in %.3fs, %.1f MB/s", len(pairs), total,
+                     elapsed, total / max(elapsed, 1e-6) / 1e6)
+        for (src, dst), (size, error) in zip(pairs, results):
+            if error is not None:
+                logging.error("Copy of %s to %s failed: %s", src, dst, error)
+        raise_damaged(error for size, error in results)
+        return all(error is None for size, error in results)
+
+    def _copy_file(self, src, dst, update, checksums=None, expected=None):
+        ''' Returns the number of bytes copied and the error raised, if any '''
+        tmp = dst + '.part'
+        try:
+            if update and os.path.exists(dst) and os.path.getmtime(dst) >= os.path.getmtime(src):
+                return 0, None
+
+            t0 = time()
+            with open(src, 'rb') as fin:
+                size = os.fstat(fin.fileno()).st_size
+                with open(tmp, 'wb') as fout:
+                    if checksums is None and expected is None:
+                        self._transfer(fin, fout, size)
+                    else:
+                        writer = checksumWriter(fout)
+                        self._write_loop(fin, writer)
+                        writer.verify(src, expected)
+                        if checksums is not None:
+                            checksums[dst] = writer.checksum()
+            os.rename(tmp, dst)
+            elapsed = time() - t0
+            logging.debug("Copied %s (%d bytes) in %.3fs, %.1f MB/s", src, size, elapsed,
+                          size / max(elapsed, 1e-6) / 1e6)
+            return size, None
+        except (OSError, IOError, checksumError) as e:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            return 0, e
+
+    def _transfer(self, fin, fout, size):
+        if size == 0:
+            return
+        try:
+            fcntl.ioctl(fout.fileno(), self.FICLONE, fin.fileno())
+            return
+        except (IOError, OSError):
+            pass
+
+        for kernel_copy in self._kernel_copies:
+            if self._kernel_transfer(kernel_copy, fin.fileno(), fout.fileno(), size):
+                return
+        self._write_loop(fin, fout)
+
+    def _write_loop(self, fin, fout):
+        while True:
+            block = fin.read(self.block_size)
+            if not block:
+                break
+            fout.write(block)
+
+    def _kernel_transfer(self, kernel_copy, fin, fout, size):
+        ''' Returns False if the method is not supported for this pair of files '''
+        copied = 0
+        while copied < size:
+            n = kernel_copy(fin, fout, min(size - copied, 1 << 30))
+            if n < 0:
+                err = ctypes.get_errno()
+                if copied == 0 and err in self._fallback_errors:
+                    return False
+                raise OSError(err, os.strerror(err))
+            if n == 0:
+                break   # the source file shrank while copying
+            copied += n
+        return True
+
+
+class archiver(object):
+    ''' Compresses checkpoint files in the background on a worker pool, off the
+        promotion and restore paths, and streams compressed files back. Compressed
+        files keep the modification time of their original
+    '''
+    suffixes = {'zlib': '.z', 'bz2': '.bz2'}
+    block_size = 1 << 20
+
+    def __init__(self, codec=checkpoint_compression, level=compression_level, num_threads=compression_threads):
+        self.codec = codec
+        self.level = level
+        self.suffix = self.suffixes[codec]
+        self.pool = ThreadPool(num_threads)
+        self.lock = Lock()
+        self.queued = set()
+
+    def _compressor(self):
+        if self.codec == 'bz2':
+            return bz2.BZ2Compressor(self.level)
+        return zlib.compressobj(self.level)
+
+    def _decompressor(self):
+        if self.codec == 'bz2':
+            return bz2.BZ2Decompressor()
+        return zlib.decompressobj()
+
+    def compressed(self, path):
+        return path + self.suffix
+
+    def compress_later(self, path, done):
+        ''' Queues path for compression, unless it already is. done(path) is called
+            once the compressed file is in place and is responsible for removing the original
+        '''
+        with self.lock:
+            if path in self.queued:
+                return
+            self.queued.add(path)
+        self.pool.apply_async(self._compress, (path, done))
+
+    def _compress(self, path, done):
+        tmp = self.compressed(path) + '.part'
+        try:
+            compressor = self._compressor()
+            with open(path, 'rb') as fin:
+                mtime = os.fstat(fin.fileno()).st_mtime
+                with open(tmp, 'wb') as fout:
+                    while True:
+                        block = fin.read(self.block_size)
+                        if not block:
+                            break
+                        fout.write(compressor.compress(block))
+                    fout.write(compressor.flush())
+            os.utime(tmp, (mtime, mtime))
+            os.rename(tmp, self.compressed(path))
+            done(path)
+        except (OSError, IOError) as e:
+            # the file was restored to or deleted in the meantime
+            logging.debug("Compression of %s abandoned: %s", path, e)
+            if os.path.exists(tmp):
+                os.remove(tmp)
+        finally:
+            with self.lock:
+                self.queued.discard(path)
+
+    def decompress(self, path, fout):
+        ''' Streams the decompressed content of the compressed form of path to fout.
+            Raises a checksumError if the compressed data is corrupt
+        '''
+        decompressor = self._decompressor()
+        with open(self.compressed(path), 'rb') as fin:
+            while True:
+                block = fin.read(self.block_size)
+                if not block:
+                    break
+                fout.write(self._decompress(decompressor.decompress, path, block))
+        if hasattr(decompressor, 'flush'):
+            fout.write(self._decompress(decompressor.flush, path))
+
+    def _decompress(self, method, path, *args):
+        try:
+            return method(*args)
+        except (zlib.error, IOError, EOFError) as e:  # bz2 reports corrupt data as IOError
+            raise checksumError("%s is corrupt: %s" % (self.compressed(path), e))
+
+
+class directoryStore(object):
+    ''' Keeps every checkpoint as a full copy of its files under location/<step>/.
+        With an archiver, the files of all but the most recent checkpoint are
+        compressed in the background, except those of the checkpoints being restored.
+        With checksums, the CRC-32 of every file is computed while it is promoted,
+        kept in location/<step>/checksums.json, and verified while it is restored
+    '''
+    checksum_file = 'checksums.json'
+
+    def __init__(self, location=safe_location, archive=None, checksums=checkpoint_checksums):
+        self.location = location
+        self.copier = copyEngine()
+        self.archive = archive
+        self.use_checksums = checksums
+        self.newest = None
+        self.lock = Lock()
+        self.pinned = {}        # step -> number of restores in progress
+
+    def _path(self, step, filename=''):
+        return os.path.join(self.location, str(step), filename)
+
+    def contains(self, step, filename):
+        path = self._path(step, filename)
+        return os.path.exists(path) or (self.archive is not None and os.path.exists(self.archive.compressed(path)))
+
+    def promote(self, step, source_dir, files):
+        ''' Stores files of source_dir as the checkpoint of step. Returns True on success '''
+        if not os.path.exists(self._path(step)):
+            os.makedirs(self._path(step))
+        checksums = {} if self.use_checksums else None
+        if not self.copier.copy([(os.path.join(source_dir, f), self._path(step, f)) for f in files],
+                                checksums=checksums):
+            self.delete(step)
+            return False
+        if checksums is not None:
+            tmp = self._path(step, self.checksum_file + '.part')
+            with open(tmp, 'w') as f:
+                json.dump(dict((os.path.basename(path), crc) for path, crc in checksums.items()), f)
+            os.rename(tmp, self._path(step, self.checksum_file))
+        self.newest = step
+        if self.archive is not None:
+            self._archive_older(step)
+        return True
+
+    def modified(self, step, filename):
+        ''' Returns the time the file of the checkpoint was written, None if it is missing '''
+        path = self._path(step, filename)
+        if os.path.exists(path):
+            return os.path.getmtime(path)
+        if self.archive is not None and os.path.exists(self.archive.compressed(path)):
+            return os.path.getmtime(self.archive.compressed(path))
+        return None
+
+    def _archive_older(self, newest):
+        ''' Queues the uncompressed files of the checkpoints older than newest '''
+        for step in os.listdir(self.location):
+            if not step.isdigit() or int(step) == newest:
+                continue
+            for name in os.listdir(self._path(step)):
+                if not name.endswith(self.archive.suffix) and not name.endswith('.part') \
+                        and name != self.checksum_file:
+                    self.archive.compress_later(self._path(step, name), self._archived)
+
+    def _archived(self, path):
+        ''' Drops the uncompressed copy of a file unless its checkpoint became the newest
+            one or is being restored, in which case it is compressed again later
+        '''
+        step = os.path.basename(os.path.dirname(path))
+        with self.lock:
+            if step != str(self.newest) and step not in self.pinned:
+                os.remove(path)
+
+    def checksums(self, step):
+        ''' Returns the CRC-32 of the files of the checkpoint of step by name '''
+        try:
+            with open(self._path(step, self.checksum_file), 'r') as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return {}
+
+    def restore(self, step, dest_dir, files, update=False):
+        ''' Copies files of the checkpoint of step into dest_dir, decompressing the
+            archived ones on the fly and verifying their checksums. With update,
+            destinations that are not older than the checkpoint are left untouched.
+            The files of step are not archived meanwhile. Returns True on success, and
+            raises a checksumError if a file is damaged
+        '''
+        key = str(step)
+        with self.lock:
+            self.pinned[key] = self.pinned.get(key, 0) + 1
+        try:
+            checksums = self.checksums(step) if self.use_checksums else {}
+            plain = [f for f in files if os.path.exists(self._path(step, f)) or self.archive is None]
+            archived = [f for f in files if f not in plain]
+            expected = dict((self._path(step, f), checksums[f]) for f in plain if f in checksums)
+            if not self.copier.copy([(self._path(step, f), os.path.join(dest_dir, f)) for f in plain], update,
+                                    expected=expected or None):
+                return False
+            errors = self.copier.pool.map(lambda f: self._unarchive(self._path(step, f), os.path.join(dest_dir, f),
+                                                                    checksums.get(f), update), archived)
+        finally:
+            with self.lock:
+                self.pinned[key] -= 1
+                if self.pinned[key] == 0:
+                    del self.pinned[key]
+        for f, error in zip(archived, errors):
+            if error is not None:
+                logging.error("Restoring %s failed: %s", f, error)
+        raise_damaged(errors)
+        return all(error is None for error in errors)
+
+    def _unarchive(self, path, dst, expected=None, update=False):
+        ''' Decompresses the archived path to dst, returns the error raised, if any '''
+        tmp = dst + '.part'
+        try:
+            if update and os.path.exists(dst) and \
+                    os.path.getmtime(dst) >= os.path.getmtime(self.archive.compressed(path)):
+                return None
+            with open(tmp, 'wb') as fout:
+                writer = checksumWriter(fout) if expected is not None else fout
+                self.archive.decompress(path, writer)
+                if expected is not None:
+                    writer.verify(path, expected)
+            os.rename(tmp, dst)
+        except (OSError, IOError, zlib.error, checksumError) as e:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            return e
+        return None
+
+    def delete(self, step):
+        shutil.rmtree(self._path(step), ignore_errors=True)
+
+
+class chunkStore(object):
+    ''' Content-addressed, deduplicated store of the checkpoints kept in location.
+        Files are split into fixed-size chunks named after their SHA-1 digest and
+        kept once under location/chunks/. A checkpoint is a directory of manifests
+        listing the chunks of each of its files. Chunks are reference-counted over
+        all manifests and removed when no checkpoint uses them anymore, so a
+        promotion only writes the chunks that changed since the previous ones.
+        With an archiver, the chunks that the most recent checkpoint does not use
+        are compressed in the background. With checksums, the CRC-32 of every file
+        is computed in the pass that splits it, kept in its manifest, and verified
+        while the file is reassembled
+    '''
+    manifest_suffix = '.manifest'
+
+    def __init__(self, location=safe_location, archive=None, chunk_size=store_chunk_size,
+                 num_threads=checkpoint_threads, checksums=checkpoint_checksums):
+        self.location = location
+        self.use_checksums = checksums
+        self.chunk_dir = os.path.join(location, 'chunks')
+        self.chunk_size = chunk_size
+        self.archive = archive
+        self.lock = Lock()
+        self.pool = ThreadPool(num_threads)
+        self.refcounts = {}
+        self.newest = set()     # chunks of the most recent checkpoint, never compressed
+        self.promotions = 0
+        if not os.path.exists(self.chunk_dir):
+            os.makedirs(self.chunk_dir)
+        self._count_references()
+
+    def _count_references(self):
+        ''' Rebuilds the reference counts from the manifests found in location '''
+        for step in os.listdir(self.location):
+            if not step.isdigit():
+                continue
+            for digest in self._digests(step):
+                self.refcounts[digest] = self.refcounts.get(digest, 0) + 1
+
+    def _digests(self, step):
+        ''' Returns the chunks referenced by the manifests of a checkpoint '''
+        digests = []
+        for name in os.listdir(self._path(step)):
+            if name.endswith(self.manifest_suffix):
+                digests += self._load_manifest(self._path(step, name))['chunks']
+        return digests
+
+    def _path(self, step, filename=''):
+        return os.path.join(self.location, str(step), filename)
+
+    def _manifest(self, step, filename):
+        return self._path(step, filename + self.manifest_suffix)
+
+    def _chunk(self, digest):
+        return os.path.join(self.chunk_dir, digest[:2], digest)
+
+    def _load_manifest(self, path):
+        with open(path, 'r') as f:
+            return json.load(f)
+
+    def contains(self, step, filename):
+        return os.path.exists(self._manifest(step, filename))
+
+    def modified(self, step, filename):
+        ''' Returns the time the file of the checkpoint was written '''
+        return os.path.getmtime(self._manifest(step, filename))
+
+    def checksums(self, step):
+        ''' Returns the CRC-32 of the files of the checkpoint of step by name '''
+        checksums = {}
+        for name in os.listdir(self._path(step)):
+            if name.endswith(self.manifest_suffix):
+                crc = self._load_manifest(self._path(step, name)).get('crc32')
+                if crc is not None:
+                    checksums[name[:-len(self.manifest_suffix)]] = crc
+        return checksums
+
+    def promote(self, step, source_dir, files):
+        ''' Stores files of source_dir as the checkpoint of step. Returns True on success '''
+        if not os.path.exists(self._path(step)):
+            os.makedirs(self._path(step))
+        with self.lock:
+            self.promotions += 1
+            promotion = self.promotions
+        t0 = time()
+        results = self.pool.map(lambda f: self._store_file(step, os.path.join(source_dir, f), f), files)
+        written = sum(r[0] for r in results if r[2] is None)
+        total = sum(r[1] for r in results if r[2] is None)
+        logging.info("Stored checkpoint %s: %d of %d bytes in new chunks, %.3fs", step, written, total, time() - t0)
+        for f, (new, size, error) in zip(files, results):
+            if error is not None:
+                logging.error("Storing %s failed: %s", f, error)
+        if any(error is not None for new, size, error in results):
+            self.delete(step)
+            return False
+        if self.archive is not None:
+            self.archive.pool.apply_async(self._archive_older, (step, promotion))
+        return True
+
+    def _archive_older(self, newest, promotion):
+        ''' Queues the uncompressed chunks that the checkpoint of newest does not use,
+            unless another promotion started since
+        '''
+        try:
+            newest_digests = set(self._digests(newest))
+        except (OSError, IOError, ValueError):
+            return  # deleted in the meantime
+        with self.lock:
+            if promotion != self.promotions:
+                return
+            self.newest = newest_digests
+            candidates = [d for d in self.refcounts if d not in newest_digests]
+        for digest in candidates:
+            if os.path.exists(self._chunk(digest)):
+                self.archive.compress_later(self._chunk(digest), self._archived)
+
+    def _archived(self, path):
+        ''' Drops the uncompressed copy of a chunk once its compressed form exists '''
+        digest = os.path.basename(path)
+        with self.lock:
+            if digest not in self.refcounts:
+                self._remove_chunk(digest)
+            elif digest not in self.newest:
+                os.remove(path)
+
+    def _store_file(self, step, src, filename):
+        ''' Returns the bytes written in new chunks, the file size and the error raised, if any '''
+        digests = []
+        written = size = crc = 0
+        try:
+            with open(src, 'rb') as f:
+                while True:
+                    block = f.read(self.chunk_size)
+                    if not block:
+                        break
+                    if self.use_checksums:
+                        crc = zlib.crc32(block, crc)
+                    digest = hashlib.sha1(block).hexdigest()
+                    digests.append(digest)
+                    size += len(block)
+                    if self._reference(digest):
+                        self._write_chunk(digest, block)
+                        written += len(block)
+            tmp = self._manifest(step, filename) + '.part'
+            manifest = {'size': size, 'chunks': digests}
+            if self.use_checksums:
+                manifest['crc32'] = crc & 0xffffffff
+            with open(tmp, 'w') as f:
+                json.dump(manifest, f)
+            os.rename(tmp, self._manifest(step, filename))
+        except (OSError, IOError) as e:
+            self._release(digests)
+            return written, size, e
+        return written, size, None
+
+    def _reference(self, digest):
+        ''' Adds a reference to a chunk, returns True if the chunk has to be written.
+            Chunks of the new checkpoint are kept uncompressed
+        '''
+        with self.lock:
+            count = self.refcounts.get(digest, 0)
+            self.refcounts[digest] = count + 1
+            self.newest.add(digest)
+        return count == 0 or not os.path.exists(self._chunk(digest))
+
+    def _release(self, digests):
+        ''' Drops one reference to each chunk and removes the unreferenced ones '''
+        with self.lock:
+            for digest in digests:
+                count = self.refcounts.get(digest, 0) - 1
+                if count > 0:
+                    self.refcounts[digest] = count
+                    continue
+                self.refcounts.pop(digest, None)
+                self._remove_chunk(digest)
+
+    def _remove_chunk(self, digest):
+        paths = [self._chunk(digest)]
+        if self.archive is not None:
+            paths.append(self.archive.compressed(self._chunk(digest)))
+        for path in paths:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def _write_chunk(self, digest, block):
+        path = self._chunk(digest)
+        if not os.path.exists(os.path.dirname(path)):
+            try:
+                os.makedirs(os.path.dirname(path))
+            except OSError:
+                pass    # created by another thread
+        tmp = '%s.%d.part' % (path, id(block))
+        with open(tmp, 'wb') as f:
+            f.write(block)
+        os.rename(tmp, path)
+
+    def _read_chunk(self, digest, fout):
+        ''' Streams a chunk to fout, decompressing it if it has been archived '''
+        try:
+            with open(self._chunk(digest), 'rb') as chunk:
+                fout.write(chunk.read())
+        except IOError:
+            if self.archive is None:
+                raise
+            self.archive.decompress(self._chunk(digest), fout)
+
+    def restore(self, step, dest_dir, files, update=False):
+        ''' Reassembles files of the checkpoint of step into dest_dir by streaming their
+            chunks. With update, destinations newer than the checkpoint are left untouched.
+            Returns True on success, and raises a checksumError if a file is damaged
+        '''
+        t0 = time()
+        results = self.pool.map(lambda f: self._restore_file(step, f, os.path.join(dest_dir, f), update), files)
+        total = sum(size for size, error in results if error is None)
+        elapsed = time() - t0
+        logging.info("Restored %d files (%d bytes) of checkpoint %s in %.3fs, %.1f MB/s", len(files),
+                     total, step, elapsed, total / max(elapsed, 1e-6) / 1e6)
+        for f, (size, error) in zip(files, results):
+            if error is not None:
+                logging.error("Restoring %s failed: %s", f, error)
+        raise_damaged(error for size, error in results)
+        return all(error is None for size, error in results)
+
+    def _restore_file(self, step, filename, dst, update):
+        ''' Returns the number of bytes restored and the error raised, if any '''
+        tmp = dst + '.part'
+        try:
+            manifest = self._manifest(step, filename)
+            if update and os.path.exists(dst) and os.path.getmtime(dst) >= os.path.getmtime(manifest):
+                return 0, None
+            contents = self._load_manifest(manifest)
+            with open(tmp, 'wb') as f:
+                writer = checksumWriter(f) if self.use_checksums else f
+                for digest in contents['chunks']:
+                    self._read_chunk(digest, writer)
+                if self.use_checksums:
+                    writer.verify(filename, contents.get('crc32'))
+            os.rename(tmp, dst)
+            return os.path.getsize(dst), None
+        except (OSError, IOError, ValueError, zlib.error, checksumError) as e:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            return 0, e
+
+    def delete(self, step):
+        ''' Removes the checkpoint of step and the chunks only it referenced '''
+        if not os.path.exists(self._path(step)):
+            return
+        for name in os.listdir(self._path(step)):
+            if name.endswith(self.manifest_suffix):
+                try:
+                    self._release(self._load_manifest(self._path(step, name))['chunks'])
+                except (IOError, ValueError) as e:
+                    logging.warning("Manifest %s of checkpoint %s could not be read: %s", name, step, e)
+        shutil.rmtree(self._path(step), ignore_errors=True)
+
+
+class checkpointStager(object):
+    ''' Restores the checkpoint a restart will use ahead of time, from a background
+        thread, into a shadow directory on the filesystem of dest_dir, so that the
+        restart itself only takes renames. Asking for a different checkpoint or set
+        of files cancels the staging in progress between two batches of files and
+        stages the new choice instead
+    '''
+
+    def __init__(self, store, dest_dir, shadow_dir, batch=checkpoint_threads):
+        self.store = store
+        self.dest_dir = dest_dir
+        self.shadow_dir = shadow_dir
+        self.batch = batch
+        self.cond = Condition()
+        self.wanted = None      # (step, files) to stage
+        self.attempted = None   # (step, files) of the last staging that finished
+        self.staged = None      # (step, files) in the shadow directory
+        self.t = Thread(target=self.stage_loop)
+        self.t.daemon = True
+        self.t.start()
+
+    def stage(self, step, files):
+        ''' Stages files of the checkpoint of step, unless they already are '''
+        with self.cond:
+            if self.wanted != (step, files):
+                self.wanted = (step, files)
+                self.cond.notify_all()
+
+    def stage_loop(self):
+        while True:
+            with self.cond:
+                while self.wanted is None or self.wanted == self.attempted:
+                    self.cond.wait()
+                target = self.wanted
+                self.staged = self.attempted = None
+            staged = self._stage(*target)
+            with self.cond:
+                self.attempted = target
+                if staged and target == self.wanted:
+                    self.staged = target
+                self.cond.notify_all()
+
+    def _stage(self, step, files):
+        t0 = time()
+        shutil.rmtree(self.shadow_dir, ignore_errors=True)
+        try:
+            os.makedirs(self.shadow_dir)
+        except OSError as e:
+            logging.error("Staging directory %s could not be created: %s", self.shadow_dir, e)
+            return False
+        for i in range(0, len(files), self.batch):
+            if self.wanted != (step, files):
+                logging.info("Staging of checkpoint %s cancelled", step)
+                return False
+            try:
+                restored = self.store.restore(step, self.shadow_dir, files[i:i + self.batch])
+            except checksumError:
+                restored = False    # left to the restart, which falls back to an older checkpoint
+            if not restored:
+                logging.warning("Staging of checkpoint %s failed", step)
+                return False
+        logging.info("Checkpoint %s staged in %.3fs", step, time() - t0)
+        return True
+
+    def swap(self, step, files, update=False):
+        ''' Waits for the staging of files of step to finish and moves them into
+            dest_dir. With update, destinations that are not older than the checkpoint
+            are left untouched, as in store.restore. Returns False if the files were not
+            staged, in which case they should be restored from the store
+        '''
+        target = (step, files)
+        with self.cond:
+            while self.wanted == target and self.attempted != target:
+                self.cond.wait()
+            if self.staged != target:
+                return False
+            self.staged = None
+        try:
+            for f in files:
+                dst = os.path.join(self.dest_dir, f)
+                if update and os.path.exists(dst):
+                    written = self.store.modified(step, f)
+                    if written is not None and os.path.getmtime(dst) >= written:
+                        continue
+                os.rename(os.path.join(self.shadow_dir, f), dst)
+        except OSError as e:
+            logging.error("Staged checkpoint %s could not be moved into place: %s", step, e)
+            return False
+        return True
+
+
+def create_store(location=safe_location):
+    ''' Returns the checkpoint store selected in config '''
+    archive = None
+    if checkpoint_compression is not None:
+        archive = archiver()
+    if dedup_checkpoints:
+        return chunkStore(location, archive)
+    return directoryStore(location, archive)
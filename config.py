@@ -8,6 +8,13 @@ sim_dump_location = '/shared/alex/brain/'
 # Safe location to keep backup files
 safe_location = '/home/alex/bak/'
 
+# Shadow directory where the restart checkpoint is staged during a repair. Must be on the
+# filesystem of sim_dump_location, so that the staged files are moved in with renames
+staging_location = sim_dump_location + '.staging/'
+
+# Journal of the checkpoints and recovery state, from which depman -r resumes a run
+catalog_file = safe_location + 'catalog.journal'
+
 # rccerun path
 rccerun_path = '/shared/alex/brain/rccerun'
 
@@ -36,3 +43,109 @@ latency = 0.23
 #Checkpoint interval optimization precision - selected intervals will be divisible by:
 prec_interv = 100
 
+
+# Follow the infoli output files through inotify events instead of mtime polling
+use_inotify = True
+
+# Sleep between mtime checks when output files are polled - in seconds
+poll_interval = 0.05
+
+# Minimum distance in bytes between the entries of the output file line indices
+line_index_stride = 65536
+
+# Suffix of the line index files stored next to the output files and checkpoints
+line_index_suffix = '.idx'
+
+# Number of threads used to scan and copy checkpoint files
+checkpoint_threads = 8
+
+# Keep the checkpoints of the safe location in a deduplicated, content-addressed chunk store.
+# if False, every checkpoint is a full copy of its files.
+dedup_checkpoints = True
+
+# Compute a CRC-32 of every checkpoint file while it is promoted and verify it while it is
+# restored. Without the chunk store, checksummed copies bypass the in-kernel copy paths
+checkpoint_checksums = True
+
+# Size of the chunks of the deduplicated checkpoint store - in bytes
+store_chunk_size = 65536
+
+# Codec used to compress older checkpoints in the background: 'zlib', 'bz2' or None.
+# The most recent checkpoint is never compressed.
+checkpoint_compression = 'zlib'
+compression_level = 6
+compression_threads = 2
+
+# Core reachability probes: 'icmp', 'tcp', 'local' or 'auto' (ICMP when privileged, else TCP)
+probe_method = 'auto'
+probe_port = 22     # port of the TCP probes
+probe_timeout = 3   # in seconds
+
+# Time between probes of a responsive core, and between the retries of a suspicious one - in seconds
+probe_interval = 1.0
+probe_retry_interval = 0.2
+
+# Number of consecutive missed probes after which a core is considered unreachable
+probe_retries = 2
+
+# Readiness of rebooted cores: a core is up once it accepts connections on boot_probe_port.
+# Sweeps of the cores still booting back off exponentially, with jitter - in seconds
+boot_probe_port = 22
+boot_backoff_initial = 0.5
+boot_backoff_max = 4.0
+
+# Number of groups of tiles that coreReboot resets concurrently
+reboot_groups = 4
+
+# Time to wait for the diagnostics to complete after the simulation exits - in seconds
+completion_timeout = 10
+
+# Seed of the tie-breaking of core allocations, so that degradations are reproducible
+allocation_seed = 0
+
+# Allocations cached across depman runs. Kept outside the safe location, which is cleared at startup
+allocation_cache_file = '/home/alex/.depman_allocations.json'
+
+# Place degraded tasks by predicted peak temperature of a steady-state heat model of the mesh
+# instead of by distance alone. Requires numpy
+thermal_placement = False
+thermal_candidates = 200    # placements scored per allocation
+
+# Heat model: conductance between neighbouring cores and to the heatsink - in W/K
+thermal_conductance = 1.0
+thermal_leakage = 0.1
+
+# Calibrated power of a core running a task, and of an idle core - in W
+task_power = 1.8
+idle_power = 0.6
+
+# Distribution fitted to the observed TTFs for the MTTF estimate: 'exponential' or 'weibull'
+mttf_estimator = 'exponential'
+
+# Confidence level of the logged MTTF confidence interval
+mttf_confidence = 0.95
+
+# Statistics of the measured checkpoint intervals and latencies used by the interval optimization:
+# 'mean', 'ewma', 'p50', 'p95' or 'p99'. A tail latency is more conservative than the mean
+checkpoint_interval_statistic = 'mean'
+checkpoint_latency_statistic = 'mean'
+
+# Weight of the latest measure in the exponentially weighted moving averages
+ewma_alpha = 0.1
+
+# Board power sampling: status command, and a local stand-in used when devel is True
+power_command = 'sccBmc -c status | grep 3V3SCC'
+power_test_command = 'echo "3V3SCC: 3.300 V, 25.000 A"'
+power_sample_interval = 1.0     # in seconds
+power_buffer_size = 3600        # samples kept for energy queries
+power_flush_interval = 10       # time between appends to the energy file - in seconds
+
+# Prometheus metrics: HTTP endpoint on metrics_address:metrics_port and/or a textfile rewritten
+# every metrics_interval seconds. None disables either one
+metrics_address = 'localhost'
+metrics_port = 9110
+metrics_textfile = None
+metrics_interval = 15
+
+# Chrome trace event file with the stages of every failure cycle. None disables tracing
+trace_file = sim_dump_location + 'times/depman_trace.json'
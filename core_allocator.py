@@ -1,3 +1,11 @@
+import os
+import json
+import logging
+from heapq import heappush, heappop
+from random import choice, Random
+from threading import Thread, Lock
+from Queue import Queue, Empty
+
 
 def coords_from_name(core_name):
     index = int(core_name[3:])
@@ -58,85 +66,242 @@ for x in range(8):
 '''
 
 
-def allocate_tasks(num_tasks, initial_cores):
-    ''' allocates num_tasks jobs on a grid of SCC cores in a thermal aware manner '''
+class mesh(object):
+    ''' A rows x cols mesh of cores. Core names are mapped to mesh coordinates
+        through coords_from_name and name_from_coords, which default to a row-major
+        numbering of the cores. The name identifies the topology in allocation caches
+    '''
+
+    def __init__(self, rows, cols, coords_from_name=None, name_from_coords=None, prefix='rck', name=None):
+        self.name = name or '%dx%d' % (rows, cols)
+        self.rows = rows
+        self.cols = cols
+        self.prefix = prefix
+        self.width = max(len(str(rows * cols - 1)), 2)
+        if coords_from_name is not None:
+            self.coords_from_name = coords_from_name
+        if name_from_coords is not None:
+            self.name_from_coords = name_from_coords
+
+    def coords_from_name(self, core_name):
+        return divmod(int(core_name[len(self.prefix):]), self.cols)
+
+    def name_from_coords(self, x, y):
+        return self.prefix + str(x * self.cols + y).zfill(self.width)
+
+    def edge_distance(self, x, y):
+        return min(x, y, self.rows - 1 - x, self.cols - 1 - y)
+
+''' The 8x6 mesh of the SCC, with two cores per tile '''
+scc_mesh = mesh(8, 6, coords_from_name, name_from_coords, name='scc')
+
+
+class _farthestPlacement(object):
+    ''' Places tasks one by one on the free cell that is farthest from the placed ones.
+        Distances are kept as integer scores of 100 * distance minus the number of
+        placed cores at that same distance, so that cells equidistant to more cores
+        rank lower. Only the cells within the distance of the farthest free cell can
+        change score on a placement. Free cells are kept in buckets by score and by
+        distance to the edge, and the highest score is found through a lazy max-heap
+    '''
+
+    def __init__(self, topology, unavailable, rng=None):
+        self.topology = topology
+        self.choice = choice if rng is None else rng.choice
+        self.rows, self.cols = topology.rows, topology.cols
+        self.unavailable = unavailable  # cell indices
+        self.placed = set()
+        self.edge = [topology.edge_distance(*divmod(c, self.cols)) for c in range(self.rows * self.cols)]
+        initial = 100 * (self.rows + self.cols)     # farther than any cell of the mesh
+        self.score = [None] * (self.rows * self.cols)
+        self.buckets = {}   # score -> edge distance -> cells
+        self.heap = []      # -score of the buckets, possibly empty ones
+        for c in range(self.rows * self.cols):
+            if c not in unavailable:
+                self._move(c, initial)
+        self.radius = self.rows + self.cols
+
+    def _move(self, c, score):
+        ''' Moves a cell to the bucket of a new score, or removes it with score None '''
+        old = self.score[c]
+        if old is not None:
+            self.buckets[old][self.edge[c]].discard(c)
+        self.score[c] = score
+        if score is not None:
+            bucket = self.buckets.get(score)
+            if bucket is None:
+                bucket = self.buckets[score] = {}
+                heappush(self.heap, -score)
+            bucket.setdefault(self.edge[c], set()).add(c)
+
+    def place(self, i, j):
+        c = i * self.cols + j
+        self.placed.add(c)
+        self.unavailable.discard(c)
+        self._move(c, None)
+
+        for x in range(max(0, i - self.radius), min(self.rows, i + self.radius + 1)):
+            w = self.radius - abs(x - i)
+            for y in range(max(0, j - w), min(self.cols, j + w + 1)):
+                c = x * self.cols + y
+                s = self.score[c]
+                if s is None:
+                    continue
+                r = 100 * (abs(x - i) + abs(y - j))
+                if r < s:
+                    self._move(c, r)
+                elif r - 100 < s:
+                    self._move(c, s - 1)
 
-    def flatten(l):
-        return [item for sublist in l for item in sublist]
+    def farthest(self):
+        ''' Returns the cells of maximum score that are closest to the edge, in row-major
+            order. When no free cell is left, these are taken among the unavailable
+            cells, or else among the placed ones
+        '''
+        while len(self.heap) > 0:
+            best = -self.heap[0]
+            bucket = self.buckets[best]
+            for edge in [e for e in bucket if len(bucket[e]) == 0]:
+                del bucket[edge]
+            if len(bucket) > 0:
+                self.radius = (best + 99) // 100
+                return [divmod(c, self.cols) for c in sorted(bucket[min(bucket)])]
+            del self.buckets[best]
+            heappop(self.heap)
 
-    def manhattan_distance(x, y, x2, y2):
-        return abs(x2 - x) + abs(y2 - y)
+        cells = self.unavailable if len(self.unavailable) > 0 else self.placed
+        closest = min(self.edge[c] for c in cells)
+        return [divmod(c, self.cols) for c in sorted(cells) if self.edge[c] == closest]
 
-    all_cores =  ['rck'+str(i).zfill(2) for i in range(48)]
+    def choose(self):
+        ''' Picks one of the farthest cells at random '''
+        return self.choice(self.farthest())
 
-    Matrix = [[1000 for x in xrange(6)] for x in xrange(8)]
 
-    for core in all_cores:
-        if core not in initial_cores:
-            x, y = coords_from_name(core)
-            Matrix[x][y] = -1
+def allocate_tasks(num_tasks, initial_cores, topology=scc_mesh, rng=None):
+    ''' allocates num_tasks jobs on a mesh of cores in a thermal aware manner.
+        Ties are broken through rng, or the random module if rng is None
+    '''
+    rows, cols = topology.rows, topology.cols
+    available = set()
+    for core in initial_cores:
+        x, y = topology.coords_from_name(core)
+        available.add(x * cols + y)
+    placement = _farthestPlacement(topology, set(range(rows * cols)) - available, rng)
 
 # NO guards: cores must be placeable
 # try to place the first core on a corner or side
-    if Matrix[0][0] != -1:
-        i = j = 0
-    elif Matrix[0][5] != -1:
-        i = 0
-        j = 5
-    elif Matrix[7][0] != -1:
-        i = 7
-        j = 0
-    elif Matrix[7][5] != -1:
-        i = 7
-        j = 5
+    for i, j in [(0, 0), (0, cols - 1), (rows - 1, 0), (rows - 1, cols - 1)]:
+        if i * cols + j in available:
+            break
     else:
-        i = j = 0
-        while Matrix[i][j] == -1:
-            j += 1
-            if (j == 5):
-                i += 1
-                j = 0
+        i, j = next((x, y) for x in range(rows) for y in range(cols - 1) if x * cols + y in available)
 
     while num_tasks > 0:
-        Matrix[i][j] = -2
+        placement.place(i, j)
         num_tasks -= 1
-        for x in range(8):
-            for y in range(6):
-                if Matrix[x][y] > 0 :
-                    r = manhattan_distance(i,j,x,y)
-                    if r < Matrix[x][y]:
-                        Matrix[x][y] = r
-                    elif r - 1 < Matrix[x][y] <= r:
-                        Matrix[x][y] -= 0.01
-
-        max_list = []
-
-        for x in range(8):
-            for y in range(6):
-                if Matrix[x][y] == max(flatten(Matrix)):
-                    max_list.append((x,y))
-
-        distance_to_edge = map(lambda (x,y):min([x,y,7-x,5-y]), max_list)
-
-        min_list = []
-        for x,y in max_list:
-                if min([x,y,7-x,5-y]) == min(distance_to_edge):
-                    min_list.append((x,y))
-
-        from random import choice
-        i,j = choice(min_list)
-
-    for i in range(8):
-        for j in range(6):
-            if 0 < Matrix[i][j] :
-                Matrix[i][j] = 0
-
-
-    result = []
-    for i in range(8):
-        print Matrix[i]
-        for j in range(6):
-            if Matrix[i][j] == -2:
-                print i,j
-                result.append(name_from_coords(i, j))
+        i, j = placement.choose()
+
+    result = [topology.name_from_coords(*divmod(c, cols)) for c in sorted(placement.placed)]
+    logging.debug("Tasks allocated on cores %s", ' '.join(result))
     return result
+
+
+class allocationCache(object):
+    ''' Memoizes allocate_tasks by topology, task count and set of available cores.
+        Every allocation breaks ties through a Random seeded with seed, so cached and
+        computed allocations agree across depman runs. Allocations are stored as JSON
+        in filename if one is given, and can be precomputed by a background thread.
+        With the 'thermal' objective, allocations minimize the predicted peak temperature
+    '''
+
+    def __init__(self, filename=None, seed=0, topology=scc_mesh, objective='distance'):
+        self.filename = filename
+        self.seed = seed
+        self.topology = topology
+        self.objective = objective
+        self.lock = Lock()
+        self.allocations = {}   # (topology name, tasks, frozenset of cores) -> allocated cores
+        self.pending = Queue()  # (tasks, cores) pairs to be precomputed
+        self.working = False
+        self.load()
+
+    def _key(self, num_tasks, cores):
+        return self.topology.name, num_tasks, frozenset(cores)
+
+    def _allocate(self, num_tasks, cores):
+        if self.objective == 'thermal':
+            from thermal import thermal_allocate
+            return thermal_allocate(num_tasks, sorted(cores), self.topology, Random(self.seed))
+        return allocate_tasks(num_tasks, sorted(cores), self.topology, Random(self.seed))
+
+    def lookup(self, num_tasks, cores):
+        ''' Returns the allocation of num_tasks on cores, computing it on a miss '''
+        key = self._key(num_tasks, cores)
+        with self.lock:
+            result = self.allocations.get(key)
+        if result is None:
+            logging.info("Allocation of %d tasks was not cached", num_tasks)
+            result = self._allocate(num_tasks, cores)
+            with self.lock:
+                self.allocations[key] = result
+            self.save()
+        return list(result)
+
+    def prefetch(self, scenarios):
+        ''' Precomputes the allocations of (tasks, cores) pairs in the background '''
+        with self.lock:
+            for num_tasks, cores in scenarios:
+                self.pending.put((num_tasks, cores))
+            if not self.working:
+                self.working = True
+                t = Thread(target=self._precompute)
+                t.daemon = True
+                t.start()
+
+    def _precompute(self):
+        computed = False
+        while True:
+            with self.lock:
+                try:
+                    num_tasks, cores = self.pending.get_nowait()
+                except Empty:
+                    self.working = False
+                    break
+                cached = self._key(num_tasks, cores) in self.allocations
+            if not cached:
+                result = self._allocate(num_tasks, cores)
+                with self.lock:
+                    self.allocations[self._key(num_tasks, cores)] = result
+                computed = True
+        if computed:
+            self.save()
+
+    def load(self):
+        if self.filename is None or not os.path.exists(self.filename):
+            return
+        try:
+            with open(self.filename, 'r') as f:
+                entries = json.load(f)
+            for entry in entries:
+                if entry['seed'] == self.seed and entry.get('objective', 'distance') == self.objective:
+                    key = (entry['topology'], entry['tasks'], frozenset(entry['cores']))
+                    self.allocations[key] = entry['allocation']
+        except (IOError, ValueError, KeyError, TypeError) as e:
+            logging.warning("Allocation cache %s could not be loaded: %s", self.filename, e)
+
+    def save(self):
+        ''' Atomically replaces the allocation cache file '''
+        if self.filename is None:
+            return
+        with self.lock:
+            entries = [{'topology': name, 'tasks': tasks, 'cores': sorted(cores),
+                        'seed': self.seed, 'objective': self.objective, 'allocation': allocation}
+                       for (name, tasks, cores), allocation in self.allocations.items()]
+        try:
+            temp = self.filename + '.tmp'
+            with open(temp, 'w') as f:
+                json.dump(entries, f)
+            os.rename(temp, self.filename)
+        except (OSError, IOError) as e:
+            logging.warning("Allocation cache %s could not be saved: %s", self.filename, e)
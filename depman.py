@@ -7,16 +7,23 @@ import json
 from signal import signal, SIGKILL, SIGINT
 from time import sleep, time
 from subprocess import Popen, call, check_output, PIPE, STDOUT
-from Queue import Queue
-from collections import deque
+from Queue import Queue, Empty
 from threading import Lock, Thread
-from math import sqrt
 
 from scc_diagnostics import processExit, coreReachability, benchmark
-from infoli_diagnostics import infoliOutputDivergence
-from scc_countermeasures import countermeasure_enum
+from infoli_diagnostics import infoliOutputDivergence, final_step
+from scc_countermeasures import countermeasure_enum, restart_checkpoint, checkpoint_files, restartSimulation
+from planner import countermeasurePlanner
 from injectors import injectorManager
 from monitors import checkpointMonitor
+from checkpoints import checkpointScanner, checkpointError, create_store, checkpointStager
+from catalog import checkpointCatalog
+from core_allocator import allocationCache
+from estimators import create_estimator, optimal_interval
+from stats import streamingStats
+from power import powerSampler
+from metrics import metricsExporter
+from tracing import tracer
 
 from config import *
 
@@ -31,6 +38,13 @@ class depman(object):
         #    sys.exit("Please provide enough arguments (nue, hostfile, restart executable, executable, parameters)");
 
         offset = 1  # argument offset
+        self.moving_avg_N = moving_avg_N
+
+        self.resuming = False
+        if sys.argv[1] == '-r':
+            ''' Resume mode: keep the safe location and resume from the newest checkpoint of the catalog '''
+            self.resuming = True
+            sys.argv.pop(1)
 
         self.fault_injection = False
         self.benchmarking = False
@@ -43,7 +57,7 @@ class depman(object):
             self.benchmarking = True
             self.fault_injection = True
             offset = 3
-            moving_avg_N = int(sys.argv[2])
+            self.moving_avg_N = int(sys.argv[2])
 
         if sys.argv[offset] == '-nue':
             self.num_cores = int(sys.argv[offset+1])
@@ -64,11 +78,6 @@ class depman(object):
         # set executables
         self.restart_exec = sys.argv[offset+4]
         self.exec_list = sys.argv[(offset+5):]
-        self.restarted = False
-        self.latencies = []
-        self.intervals = []
-        self.interval = self.latency = 1
-        self.initial_steps = int(self.exec_list[-1])
 
         # parse initial list of cores from the hosts file
         self.hostfd = open(os.path.join(os.getcwd(), self.hostfile), 'r')
@@ -78,7 +87,8 @@ class depman(object):
         self.cores = self.initial_cores[:]
 
         # TODO: measurements
-        self.energy = open(sim_dump_location + 'times/energy200', 'w')
+        self.power = powerSampler(power_test_command if devel else power_command,
+                                  sim_dump_location + 'times/energy200')
         self.mttffd = open(sim_dump_location + 'MTTF_estimates', 'w')
 
         # infoli-specific
@@ -101,12 +111,11 @@ class depman(object):
         # set simulation directory as attribute
         self.sim_dir = sim_dump_location
 
-        self.prev_globalmax = 0     # (infoli-specific) previous maximum recoverable simulation step
-        self.min_step = 120000           # infoli-specific
-        self.checkpoints = []     # locations of checkpoints
+        self.scanner = checkpointScanner()
 
         # create the safe location if it doesnt exist
-        call(['rm','-rf', safe_location])
+        if not self.resuming:
+            call(['rm','-rf', safe_location])
         if not os.path.exists(safe_location):
             try:
                 os.makedirs(safe_location)
@@ -118,11 +127,21 @@ class depman(object):
         else:
             print "cleaning up safe location"
 
-        # The depman lock is held by the master thread while a simulation is running
-        self.lock = Lock()
+        self.store = create_store(safe_location)
+        self.stager = checkpointStager(self.store, sim_dump_location, staging_location)
+        self.allocations = allocationCache(allocation_cache_file, allocation_seed,
+                                           objective='thermal' if thermal_placement else 'distance')
+        self.catalog = checkpointCatalog(catalog_file)
+        self.init_policy_state()
 
         # start simulation and create the diagnostics
-        self.rccerun(self.exec_list, True)
+        resumed = None
+        if self.resuming and self.catalog.load():
+            resumed = self.resume()
+        if resumed is None:
+            self.rccerun(self.exec_list, True)
+        else:
+            self.rccerun([self.restart_exec] + self.exec_list[1:], True)
 
         sleep(3) #wait for the task to be initially spawned at the SCC 
         self.diagnostics = []
@@ -134,7 +153,7 @@ class depman(object):
             if 'infoliOutputDivergence' in diagnostics:
                 self.diagnostics.append(infoliOutputDivergence(self))
             if 'coreReachability' in diagnostics:
-                self.diagnostics.append(coreReachability(self, 3))
+                self.diagnostics.append(coreReachability(self))
             if 'infoliOutputDivergence' not in diagnostics and use_SDC_checkpoint:
                 print "use_SDC_checkpoint is True but no SDC detection diagnostic is used."
                 loggin.warning("use_SDC_checkpoint is True but no SDC detection diagnostic is used.")
@@ -144,13 +163,7 @@ class depman(object):
         if self.benchmarking or 'coreReachability' not in diagnostics:
             checkpointMonitor(self)
 
-        # Initialize the countermeasure procedure
-        self.current_counter_proc = []
-
-        # Initialize MTTF and MTTR estimation
-        self.timestamp = 0  # initialized for when no diagnostics ever fail
-        self.mttf_values = deque([], moving_avg_N)
-        self.mttr_values = []
+        # Start the TTF timer
         self.failure_timestamp = time()
 
         # Start the fault injection manager if requested
@@ -159,11 +172,88 @@ class depman(object):
             self.injector = injectorManager(self.diagnostics)
             logging.info("Fault Injection module initialized")
 
+        self.metrics = metricsExporter(self)
+        if trace_file is not None:
+            tracer.open(trace_file)
+
         # Set the killfoli sigint handler
         signal(SIGINT, self.sigint_handler)
 
+    def init_policy_state(self):
+        ''' Initializes the state of the recovery policy: checkpoints, estimations
+            and countermeasures. Requires self.exec_list and self.moving_avg_N
+        '''
+        self.restarted = False
+        self.latencies = streamingStats()
+        self.intervals = streamingStats()
+        self.interval = self.latency = 1
+        self.initial_steps = int(self.exec_list[-1])
+
+        self.prev_globalmax = 0     # (infoli-specific) previous maximum recoverable simulation step
+        self.min_step = 120000           # infoli-specific
+        self.checkpoints = []     # locations of checkpoints
+
+        # The depman lock is held by the master thread while a simulation is running
+        self.lock = Lock()
+
+        # Failures and completions reported by the diagnostics, consumed by the event loop
+        self.events = Queue()
+
+        # Initialize the countermeasure procedure, and the durations of each countermeasure
+        self.current_counter_proc = []
+        self.countermeasure_times = {}
+
+        # Initialize MTTF and MTTR estimation
+        self.timestamp = 0  # initialized for when no diagnostics ever fail
+        self.estimator = create_estimator(mttf_estimator, self.moving_avg_N)
+        self.mttr_values = []
+
+    def resume(self):
+        ''' Restores the recovery state of the catalog and the files of its newest valid
+            checkpoint. Returns the step of that checkpoint, or None to start over
+        '''
+        for t, failed in self.catalog.observations:
+            self.estimator.observe(t, failed)
+        self.mttr_values = list(self.catalog.mttr_values)
+        if self.catalog.interval is not None:
+            self.exec_list[-1] = str(self.catalog.interval)
+        if self.catalog.estimates is not None:
+            self.interval, self.latency, self.initial_steps = self.catalog.estimates
+        else:
+            # measured again during the resumed run, which checkpoints every exec_list[-1] steps
+            self.initial_steps = int(self.exec_list[-1])
+        if self.catalog.cores is not None:
+            self.initial_cores = map(str, self.catalog.initial_cores)
+            self.change_cores(map(str, self.catalog.cores))
+
+        record = self.catalog.newest(self.store)
+        if record is None:
+            logging.warning("No valid checkpoint in the catalog, starting the simulation over")
+            return None
+        step = record['step']
+        for newer in [s for s in self.catalog.checkpoints if s > step]:
+            self.store.delete(newer)
+            self.catalog.deleted(newer)
+        self.checkpoints = sorted(self.catalog.checkpoints)
+
+        restart = restartSimulation(self)
+        restart.checkpoint = step
+        if not restart.restore_checkpoint():
+            return None
+        step = restart.checkpoint     # older if the newest one was damaged
+        self.prev_globalmax = step
+        self.restarted = self.catalog.estimates is not None
+        logging.info("Resuming from simulation step %d with %d checkpoints and %d TTF observations",
+                     step, len(self.checkpoints), len(self.catalog.observations))
+        return step
+
+    def observe(self, t, failed=True):
+        ''' Adds a TTF observation to the MTTF estimator and the catalog '''
+        self.estimator.observe(t, failed)
+        self.catalog.observed(t, failed)
+
     def halt_injectors(self):
-        self.injector.halt = True
+        self.injector.stop()
 
     def update_cellcount(self):
         self.cellcount = self.cells / len(self.cores)
@@ -190,8 +280,23 @@ class depman(object):
 
     def reinitialize_diagnostics(self):
         ''' forces a reinitialization of the diagnostics for the new simulation '''
+        while not self.events.empty():
+            self.events.get_nowait()    # discard the events of the previous run
         map(lambda d:d.reinit(), self.diagnostics)
 
+    def report(self, diagnostic, status):
+        ''' Called by the diagnostics when they fail or complete '''
+        self.events.put((diagnostic, status))
+
+    def prestage(self):
+        ''' Starts staging the checkpoint of the restart in the background, or restarts
+            the staging if the choice of checkpoint changed. The failed diagnostics must
+            have waited, so that min_step is final
+        '''
+        checkpoint = restart_checkpoint(self)
+        if checkpoint is not None:
+            self.stager.stage(checkpoint, checkpoint_files(self, checkpoint))
+
     def unset_failed_diagnostics(self):
         ''' unsets the failed flag from all diagnostics '''
         for i in self.diagnostics:
@@ -212,36 +317,17 @@ class depman(object):
     def new_DUE_checkpoint(self):
         ''' returns True if a new valid DUE checkpoint was found '''
         # TODO: move it somewhere more infoli-specific?
-        import struct
-        steps = []
-
         if devel:
             cellstate_size = 172
         else:
             cellstate_size = 168
 
-        for i in range(len(self.cores)):
-            steps.append([])
-            with open(sim_dump_location + 'ckptFile%d.bin' % i, 'rb') as f:
-                chunk = f.read(12)
-                if (len(chunk) < 12):
-                    logging.error("Checkpoint file %d is too short", i)
-                    return False
-                header = struct.unpack('iii', chunk)
-                if header[0] * header[1] != len(self.cores) * self.cellcount:
-                    logging.error("Checkpoint file %d contains invalid grid dimensions", i)
-                    return False
-                steps[i].append(header[2])
-                chunk = f.read(cellstate_size * self.cellcount)
-                if (len(chunk) < cellstate_size * self.cellcount):
-                    logging.error("Checkpoint file %d is too short", i)
-                    return False
-                chunk = f.read(4)
-                if (len(chunk) < 4):
-                    logging.error("Checkpoint file %d is too short", i)
-                    return False
-
-                steps[i].append(struct.unpack('i', chunk)[0])
+        try:
+            steps = self.scanner.scan([sim_dump_location + 'ckptFile%d.bin' % i for i in range(len(self.cores))],
+                                      cellstate_size, self.cellcount, len(self.cores) * self.cellcount)
+        except checkpointError as e:
+            logging.error(str(e))
+            return False
 
         # Determine the max common simulation step, TODO:infoli-specific
         globalmax = max(steps[0][0], steps[0][1])
@@ -262,12 +348,19 @@ class depman(object):
                 logging.warning("Checkpoint File %d does not contain simulation step %d", i, globalmax)
                 return False
 
-        call( ['mkdir', safe_location + str(globalmax)])
+        files = []
         for i in range(len(self.cores)):
-            call( ['cp', '-f', '--remove-destination', sim_dump_location + 'ckptFile%d.bin' %i, safe_location + str(globalmax)])
-            call( ['cp', '-f', '--remove-destination', sim_dump_location + 'InferiorOlive_Output%d.txt' %i, safe_location + str(globalmax)]) # Porting Option 1 format
+            files.append('ckptFile%d.bin' %i)
+            files.append('InferiorOlive_Output%d.txt' %i) # Porting Option 1 format
+            if os.path.exists(sim_dump_location + files[-1] + line_index_suffix):
+                files.append(files[-1] + line_index_suffix)
+        if not self.store.promote(globalmax, sim_dump_location, files):
+            logging.error("Checkpoint for simstep %d could not be stored", globalmax)
+            return False
 
         self.checkpoints.append(globalmax)
+        self.catalog.promoted(globalmax, dict((f, os.path.getsize(sim_dump_location + f)) for f in files),
+                              self.cores, self.store.checksums(globalmax))
         print self.checkpoints
 
         logging.info("A new DUE checkpoint has been stored for simstep %d", globalmax)
@@ -287,15 +380,16 @@ class depman(object):
 
         print [rccerun_path] + ['-nue'] + [str(len(self.cores))] + \
                         ['-f'] + [self.hostfile] + exec_list
-        if pipe:
-            self.simulation = Popen( \
-                        [rccerun_path] + ['-nue'] + [str(len(self.cores))] + \
-                        ['-f'] + [self.hostfile] + exec_list,
-                        stderr=STDOUT, stdout=PIPE)
-        else:
-            self.simulation = Popen( \
-                        [rccerun_path] + ['-nue'] + [str(len(self.cores))] + \
-                        ['-f'] + [self.hostfile] + exec_list)
+        with tracer.span('rccerun'):
+            if pipe:
+                self.simulation = Popen( \
+                            [rccerun_path] + ['-nue'] + [str(len(self.cores))] + \
+                            ['-f'] + [self.hostfile] + exec_list,
+                            stderr=STDOUT, stdout=PIPE)
+            else:
+                self.simulation = Popen( \
+                            [rccerun_path] + ['-nue'] + [str(len(self.cores))] + \
+                            ['-f'] + [self.hostfile] + exec_list)
 
         logging.info("Simulation initialized for %d cores", len(self.cores))
 
@@ -323,62 +417,103 @@ class depman(object):
         '''
         logging.info("waiting for simulation") #verbose
         ret = self.simulation.wait() 
+        exited = time()
         logging.info("Simulation returned exit code: %d", ret) #verbose
-        self.wait_diagnostics()
-
-        process = Popen("sccBmc -c status | grep 3V3SCC",
-                shell=True,
-                stdout=PIPE,
-                )
-        stdout_list = process.communicate()[0].split('\n')
-        print stdout_list
-        self.energy.write(str(time()) + " " + str(stdout_list) + '\n')
-        self.energy.flush()
-
-        # Execution is completed when the simulation is stopped with no failed diagnostics
+        tracer.instant('simulation exited', code=ret)
+        with tracer.span('wait diagnostics'):
+            self.wait_diagnostics()
+
+        # Execution is completed when the simulation is stopped with no failed diagnostics.
+        # Block on the diagnostic events until one fails or all of them complete.
+        # Diagnostics that make no progress for completion_timeout seconds fail:
+        # the simulation exited before writing its whole output
         failed = self.failed_diagnostics()
-        while len(failed) == 0 and any(map(lambda x: not x.completed, self.diagnostics)):
-            # wait for incomplete diagnostics
+        waited = len(failed) != 0
+        if waited:
+            self.prestage()     # min_step is final once the failed diagnostics have waited
+        progress = [x.progress() for x in self.diagnostics]
+        deadline = time() + completion_timeout
+        while len(failed) == 0 and not all(x.completed() for x in self.diagnostics):
+            remaining = deadline - time()
+            if remaining <= 0:
+                current = [x.progress() for x in self.diagnostics]
+                if current != progress:
+                    progress = current  # still catching up with the output
+                    deadline = time() + completion_timeout
+                    continue
+                logging.warning("Diagnostics made no progress for %d seconds", completion_timeout)
+                # the simulation has exited, so there is nothing left to stop
+                self.timestamp = exited
+                self.stopped = True
+                for diagnostic in self.diagnostics:
+                    if not diagnostic.completed():
+                        diagnostic.fail()
+                failed = self.failed_diagnostics()
+                break
+            try:
+                diagnostic, status = self.events.get(timeout=remaining)
+                logging.debug("%s diagnostic %s", diagnostic.__class__.__name__, status)
+            except Empty:
+                pass
             failed = self.failed_diagnostics()
+        if len(failed) != 0 and not waited:
+            self.wait_diagnostics()     # failed since they waited, they record where their detection stopped
 
         if len(failed) == 0:
                 logging.info("No diagnostics failed, exiting")
+                self.observe(time() - self.failure_timestamp, failed=False)
+                logging.info("Energy: %f J in total, %f J per simulation step",
+                             self.power.total_energy, self.power.total_energy / final_step)
+                self.power.wait()
+                tracer.close()
                 self.completed = True
                 return
 
         # Calculate the TTF if the simulation stopped manually and add it to the previous observed values
         if self.timestamp > 0:
-            mttf = self.timestamp - self.failure_timestamp
-            self.mttf_values.append(mttf)
-            mttf_estimate = sum(self.mttf_values) / float(len(self.mttf_values))
+            self.observe(self.timestamp - self.failure_timestamp)
+        estimate = self.estimator.estimate()
+        if estimate is not None:
+            mttf_estimate, mttf_low, mttf_high = estimate
             print "MTTF estimate: " + str(mttf_estimate)
-            logging.info("MTTF estimate: " + str(mttf_estimate))
+            logging.info("MTTF estimate: %f, %d%% confidence interval: %f - %f", mttf_estimate,
+                         self.estimator.confidence * 100, mttf_low, mttf_high)
             self.mttffd.write(str(time()) + " " + str(mttf_estimate)+"\n") 
             self.mttffd.flush()
 
         # Estimation of Checkpoint Interval and Latency
         if len(self.intervals) != 0:
-            self.interval = sum(self.intervals) / len(self.intervals)
+            self.interval = self.intervals.get(checkpoint_interval_statistic)
+            logging.info("Checkpoint intervals: %s", self.intervals.summary())
 
         if len(self.latencies) != 0:
-            self.latency = sum(self.latencies) / len(self.latencies)
+            self.latency = self.latencies.get(checkpoint_latency_statistic)
+            logging.info("Checkpoint latencies: %s", self.latencies.summary())
+
+        if len(self.intervals) != 0 or len(self.latencies) != 0:
+            self.catalog.estimates_measured(self.interval, self.latency, self.initial_steps)
 
         print "estimated checkpoint interval: " + str(self.interval)
         print "estimated checkpoint latency: " + str(self.latency)
         # CI optimization
-        # TODO: add case for latency > 1/2 mttf
-        #mttf_estimate = int(open(benchmarkInjectorFile).read())
-        #print "mttf value: " + str(mttf_estimate)
-        tau_opt = sqrt(2 * mttf_estimate * self.latency) - self.latency 
-        print "optimal checkpoint interval in time: " + str(tau_opt)
-        tau_opt_literal_steps = self.initial_steps * tau_opt / self.interval
-        tau_opt_steps = int(round(tau_opt_literal_steps / prec_interv) * prec_interv)
-        self.exec_list[-1] = str(abs(tau_opt_steps))
-        print "optimal checkpoint interval in steps:" + str(abs(tau_opt_steps)) 
-        logging.info("New optimal checkpoint interval in steps:" + str(self.exec_list[-1]))
+        if estimate is None:
+            logging.warning("No MTTF estimate, keeping the checkpoint interval of %s steps", self.exec_list[-1])
+        else:
+            tau_opt = optimal_interval(mttf_estimate, self.latency)
+            print "optimal checkpoint interval in time: " + str(tau_opt)
+            tau_opt_literal_steps = self.initial_steps * tau_opt / self.interval
+            tau_opt_steps = int(round(tau_opt_literal_steps / prec_interv) * prec_interv)
+            self.exec_list[-1] = str(max(tau_opt_steps, prec_interv))
+            self.catalog.interval_chosen(int(self.exec_list[-1]))
+            print "optimal checkpoint interval in steps:" + str(self.exec_list[-1]) 
+            logging.info("New optimal checkpoint interval: %f s, %s steps", tau_opt, self.exec_list[-1])
 
         # Check if a new countermeasure procedure needs to be calculated
-        advance = self.new_DUE_checkpoint()
+        with tracer.span('new DUE checkpoint'):
+            advance = self.new_DUE_checkpoint()
+        if self.prev_globalmax > 0:
+            logging.info("Energy: %f J per checkpointed simulation step",
+                         self.power.total_energy / self.prev_globalmax)
         procedure_failed = len(self.current_counter_proc) == 0
         if (not advance) and len(self.mttr_values) == 0:
             logging.error("No valid checkpoint was created. Simulation cannot be restarted")
@@ -387,31 +522,33 @@ class depman(object):
         if (not advance) and procedure_failed and len(self.mttr_values) > 0:
             logging.error("Countermeasure procedure was fully performed and no new checkpoints were created")
             map(lambda x:x.degrade(), failed) # Degrade the simulation state 
+            self.catalog.cores_changed(self.initial_cores, self.cores)
         if advance or procedure_failed:
             self.current_counter_proc = self.determine_countermeasures()
             logging.info("New countermeasure procedure determined")
+        self.prestage()
 
 
         # Perform the next sequence from the list of countermeasures
         print "performing countermeasures"
         while len(self.current_counter_proc) > 0:
-            countermeasures = self.current_counter_proc.pop(0)
-            cfailed = False
-            for step in countermeasures:
-                if not step.perform():
-                    cfailed = True
-                    break
-            if not cfailed:
+            plan = countermeasurePlanner(self.current_counter_proc.pop(0))
+            done = plan.run()
+            for name, duration in plan.durations():
+                self.countermeasure_times.setdefault(name, streamingStats()).add(duration)
+            if done:
                 break
 
         print "reinitializing diagnostics"
         self.unset_failed_diagnostics()
         self.stopped = False
-        self.reinitialize_diagnostics()
+        with tracer.span('reinitialize diagnostics'):
+            self.reinitialize_diagnostics()
 
         # Calculate the TTR
         mttr = time() - self.timestamp
         self.mttr_values.append(mttr)
+        self.catalog.repaired(mttr)
         print "MTTR estimate: " + str(sum(self.mttr_values) / float(len(self.mttr_values))) # DEBUG
         logging.info("MTTR estimate: " + str(sum(self.mttr_values) / float(len(self.mttr_values))))
         print "Repair Completed" #DEBUG
@@ -421,28 +558,28 @@ class depman(object):
 
         # Reinitialize injectors
         if self.fault_injection:
-            sleep(18) # TODO: MEASUREMENTS
-            print "reinitializing injectors"
-            self.injector.reinit_injectors()
+            with tracer.span('reinitialize injectors'):
+                sleep(18) # TODO: MEASUREMENTS
+                print "reinitializing injectors"
+                self.injector.reinit_injectors()
+        tracer.repair_completed()
 
         #measurements
-        process = Popen("sccBmc -c status | grep 3V3SCC",
-                shell=True,
-                stdout=PIPE,
-                )
-        stdout_list = process.communicate()[0].split('\n')
-        self.energy.write(str(time()) + " " + str(stdout_list) + "\n")
-        self.energy.flush()
+        energy = self.power.energy(self.timestamp, time())
+        if energy is not None:
+            logging.info("Recovery energy: %f J", energy)
 
     def stop(self):
         ''' Halt the simulation using a kill script and 
             a SIGKILL on the RCCE process
         '''
-        with self.lock:
+        with self.lock, tracer.span('stop'):
             self.timestamp = time()
             self.stopped = True
             if self.fault_injection:
                 self.halt_injectors()
+            if self.simulation.returncode is not None:
+                return  # already exited and reaped, its pid may have been reused
             call( [rccerun_path] + ['-nue'] + [str(self.num_cores)] + \
                     ['-f'] + [self.hostfile] + [killfoli_path])
             try:
@@ -0,0 +1,124 @@
+import abc
+from math import sqrt, log, exp, erf, gamma
+from collections import deque
+
+from config import mttf_estimator, mttf_confidence, moving_avg_N
+
+
+def normal_quantile(p):
+    ''' Quantile of the standard normal distribution, by bisection of its CDF '''
+    low, high = -10.0, 10.0
+    for i in range(60):
+        mid = (low + high) / 2
+        if 0.5 * (1 + erf(mid / sqrt(2))) < p:
+            low = mid
+        else:
+            high = mid
+    return (low + high) / 2
+
+
+def chi2_quantile(p, dof):
+    ''' Wilson-Hilferty approximation of the quantile of the chi-square distribution '''
+    h = 2.0 / (9 * dof)
+    return dof * max(1 - h + normal_quantile(p) * sqrt(h), 0) ** 3
+
+
+def optimal_interval(mttf, latency):
+    ''' Daly's higher-order estimate of the optimal checkpoint interval in time.
+        Past a latency of twice the MTTF, checkpointing every MTTF is optimal
+    '''
+    if latency >= 2 * mttf:
+        return mttf
+    x = latency / (2.0 * mttf)
+    return sqrt(2 * latency * mttf) * (1 + sqrt(x) / 3 + x / 9) - latency
+
+
+class estimator(object):
+    ''' MTTF estimators fit a TTF distribution to the last window observations.
+        Observations are failures, or censored times of runs that ended without one
+    '''
+    __metaclass__ = abc.ABCMeta
+
+    def __init__(self, window=moving_avg_N, confidence=mttf_confidence):
+        self.observations = deque()     # (time, failed) pairs
+        self.window = window
+        self.confidence = confidence
+        self.total_time = 0.0
+        self.failures = 0
+
+    def observe(self, t, failed=True):
+        ''' Adds an observation, evicting the oldest one past the window '''
+        self.observations.append((t, failed))
+        self.total_time += t
+        self.failures += failed
+        if len(self.observations) > self.window:
+            t, failed = self.observations.popleft()
+            self.total_time -= t
+            self.failures -= failed
+
+    def exponential_estimate(self):
+        ''' Returns the maximum likelihood MTTF of an exponential TTF, total time over
+            failures, with its chi-square confidence interval. None without failures
+        '''
+        if self.failures == 0:
+            return None
+        alpha = 1 - self.confidence
+        low = 2 * self.total_time / chi2_quantile(1 - alpha / 2, 2 * self.failures + 2)
+        high = 2 * self.total_time / chi2_quantile(alpha / 2, 2 * self.failures)
+        return self.total_time / self.failures, low, high
+
+    @abc.abstractmethod
+    def estimate(self):
+        ''' Returns the MTTF estimate and the bounds of its confidence interval, or None
+            if there is no estimate yet
+        '''
+        return
+
+
+class exponentialEstimator(estimator):
+    ''' Fits an exponential TTF '''
+
+    def estimate(self):
+        return self.exponential_estimate()
+
+
+class weibullEstimator(estimator):
+    ''' Maximum likelihood fit of a Weibull TTF. The shape is found by bisection over
+        the observations of the window, and the confidence interval is approximated by
+        the relative interval of the exponential fit. Falls back to the exponential fit
+        with less than two failures
+    '''
+
+    def shape(self):
+        times = [(max(t, 1e-9), failed) for t, failed in self.observations]
+        mean_log = sum(log(t) for t, failed in times if failed) / self.failures
+        low, high = log(0.02), log(50)
+        for i in range(60):
+            k = exp((low + high) / 2)
+            logs = [k * log(t) for t, failed in times]
+            top = max(logs)
+            weights = [exp(l - top) for l in logs]    # t^k, scaled to avoid overflow
+            weighted = sum(w * log(t) for w, (t, failed) in zip(weights, times)) / sum(weights)
+            if weighted - 1 / k - mean_log < 0:
+                low = log(k)
+            else:
+                high = log(k)
+        return exp((low + high) / 2)
+
+    def estimate(self):
+        if self.failures < 2:
+            return self.exponential_estimate()
+        k = self.shape()
+        times = [max(t, 1e-9) for t, failed in self.observations]
+        scale = (sum(t ** k for t in times) / self.failures) ** (1 / k)
+        mttf = scale * gamma(1 + 1 / k)
+        exponential, low, high = self.exponential_estimate()
+        return mttf, mttf * low / exponential, mttf * high / exponential
+
+
+def create_estimator(kind=mttf_estimator, window=moving_avg_N):
+    if kind == 'weibull':
+        return weibullEstimator(window)
+    elif kind == 'exponential':
+        return exponentialEstimator(window)
+    raise ValueError("Unknown MTTF estimator " + str(kind))
@@ -4,6 +4,13 @@ from monitors import lineProcessor, fileReader
 from injectors import infoliInjector
 from scc_diagnostics import diagnostic 
 
+try:
+    import numpy
+except ImportError:
+    numpy = None    # chunks are validated line by line
+
+final_step = 120000     # last simulation step of an infoli run
+
 class infoliOutputDivergence(diagnostic):
     def __init__(self, manager):
         self.manager = manager
@@ -36,11 +43,20 @@ class infoliOutputDivergence(diagnostic):
 
     def completed(self):
         # returns true if all threads have completed
-        for i in range(self.manager.cores):
-            if self.readers[i].line_processor.simstep < 120000:
+        for reader in self.readers:
+            if reader.line_processor.simstep < final_step:
                 return False
         return True
 
+    def progress(self):
+        # the slowest reader bounds the completion
+        return min(reader.line_processor.simstep for reader in self.readers)
+
+    def reader_completed(self):
+        ''' Called by the line processors when they reach the final simulation step '''
+        if self.completed():
+            self.manager.report(self, 'completed')
+
     def countermeasure_procedure(self):
         from scc_countermeasures import restartSimulation, coreReboot, platformReinitialization
         return [[restartSimulation(self.manager)], \
@@ -69,6 +85,66 @@ class infoliLineProcessor(lineProcessor):
         except ValueError:
             raise AssertionError
 
+    def process_lines(self, lines, fatal=lambda line: True):
+        ''' Validates a whole chunk of lines at once: the voltages of every well-formed
+            line before the first fatal malformed one are parsed into a single array,
+            and the range, NaN and simstep checks run over the array. Like the line by
+            line processing, it stops at the first failing line. Falls back to line by
+            line processing without numpy or when some element of the chunk cannot be parsed
+        '''
+        if numpy is None:
+            return lineProcessor.process_lines(self, lines, fatal)
+
+        expected = self.expected_length()
+        rows = []
+        positions = []  # position in lines of every row
+        malformed = []
+        for i, line in enumerate(lines):
+            linelist = line.split()
+            if len(linelist) != expected:
+                malformed.append(i)
+                if fatal(line):
+                    break
+            else:
+                rows.append(linelist)
+                positions.append(i)
+        if len(rows) == 0:
+            return malformed
+
+        try:
+            steps = numpy.array([int(row[0]) for row in rows])
+            voltages = numpy.array([row[3:] for row in rows], dtype=float)
+        except ValueError:
+            return lineProcessor.process_lines(self, lines, fatal)
+
+        # skip simsteps of previous chunks, as well as repeated steps within the chunk
+        previous = numpy.maximum.accumulate(numpy.concatenate(([self.simstep], steps[:-1])))
+        new = steps > previous
+        invalid = new & (numpy.isnan(voltages) | (voltages < -100) | (voltages > 100)).any(axis=1)
+        if invalid.any():
+            first = invalid.argmax()
+            self.step_to(int(steps[first]))
+            logging.error("Voltage of core %d exceeded threshold at simstep %d", self.core, self.simstep)
+            self.diagnostic.fail()
+            return [i for i in malformed if i < positions[first]]
+
+        if new.any():
+            self.step_to(int(steps[new][-1]))
+        return malformed
+
+    def step_to(self, simstep):
+        ''' Advances the processor to a validated simstep '''
+        done = self.simstep >= final_step
+        self.simstep = simstep
+        if not done and simstep >= final_step:
+            self.diagnostic.reader_completed()
+
+    def line_key(self, line):
+        try:
+            return int(line.split(None, 1)[0])
+        except (ValueError, IndexError):
+            return None
+
     def break_condition(self, line):
         return line.split()[0] == '#simSteps'
 
@@ -81,13 +157,13 @@ class infoliLineProcessor(lineProcessor):
         except ValueError, TypeError:
             logging.error("Possible SDC: simstep could not be parsed as int")
             self.diagnostic.fail()
-            return
+            return False
 
         #if self.core == 0:
             #print simstep
         if simstep <= self.simstep:
-            return # skip simsteps of previous chunks
-        self.simstep = simstep
+            return True # skip simsteps of previous chunks
+        self.step_to(simstep)
 
         for voltage in linelist[3:]:
             try:
@@ -95,10 +171,11 @@ class infoliLineProcessor(lineProcessor):
             except ValueError, TypeError:
                 logging.error("Possible SDC: voltage could not be parsed as float")
                 self.diagnostic.fail()
-                return
-            if (v < -100) or (v > 100):
+                return False
+            if (v < -100) or (v > 100) or v != v:   # v != v for NaN
                 logging.error("Voltage %s of core exceeded threshold")
                 self.diagnostic.fail()
-                return
+                return False
+        return True
 
 
@@ -1,11 +1,12 @@
 import abc
 import logging
-from threading import Thread, Lock
+from heapq import heappush, heappop
+from threading import Thread, Lock, Event
 from subprocess import call
-from random import randrange, random
+from random import randrange, expovariate
 from time import sleep, time
 from config import *
-from math import exp
+from tracing import tracer
 
 
 class injector(object):
@@ -20,13 +21,13 @@ class injector(object):
         self.times = []
         for line in self.f.readlines():
             tokens = line.split()
+            if len(tokens) < 2:
+                continue    # empty line
             self.times.append(int(tokens[0]))
             self.mttfs.append(int(tokens[1]))
-        self.timestamp = time()
-        self.probability = 0
         self.current_mttf = self.mttfs[0]
         self.current_index = 0
-        self.final_index = False
+        self.injections = 0
         if len(self.times) > 1:
             self.current_index = 1
             
@@ -36,51 +37,60 @@ class injector(object):
     def inject(self):
         return
 
-    def new_timestamp(self):
-        ''' replace the old timestamp - used to to avoid high probabilities after restart'''
-        self.timestamp = time()
-
-    def update(self):
-        ''' update the injector's probability for the next timestep '''
-        timestamp = time()
+    def switch_times(self):
+        ''' Returns the times of the remaining MTTF switches of the injector file '''
+        if self.current_index == 0:
+            return []
+        return [self.t0 + t for t in self.times[self.current_index:]]
+
+    def switch_mttf(self):
+        ''' Moves to the next MTTF of the injector file '''
+        self.current_mttf = self.mttfs[self.current_index]
+        print "Injection MTTF changed to " + str(self.current_mttf)
+        logging.info("Injection MTTF changed to " + str(self.current_mttf))
+        # #TODO: measurements measurements
+        self.diagnostic.manager.mttffd.write("### MTTF switch")
+        self.diagnostic.manager.mttffd.flush()
+        self.current_index += 1
+
+    def next_failure(self, now):
+        ''' Draws the time of the next failure after now from an exponential TTF
+            distribution that follows the piecewise MTTF schedule of the injector file.
+            Returns None if the schedule contains a zero MTTF
+        '''
+        hazard = expovariate(1)     # the failure occurs when the cumulative hazard reaches this value
+        elapsed = now - self.t0
+        index = self.current_index
+        mttf = float(self.current_mttf)
         while True:
-            if not self.final_index and (time() - self.t0) > self.times[self.current_index] :
-                self.current_mttf = self.mttfs[self.current_index]
-                print len(self.times)
-                print ">>>>>>>>>>>>>. time exceeded" # TODO measurements
-                print "Injection MTTF changed to " + str(self.mttfs[self.current_index])
-                logging.info("Injection MTTF changed to " + str(self.mttfs[self.current_index]))
-                # #TODO: measurements measurements
-                self.diagnostic.manager.mttffd.write("### MTTF switch")
-                self.diagnostic.manager.mttffd.flush()
-                if self.current_index < len(self.times) - 1:
-                    self.current_index += 1
-                else:
-                     self.final_index = True
-            try:
-                deltat = timestamp - self.timestamp
-                self.probability = 1 - exp(-(deltat/self.current_mttf)) # TODO: parameterize for different TTF distributions
-                break
-            except ValueError: # raised by empty line, EOF or error
-                self.f.seek(0)  # start from the top of the file
-            except ZeroDivisionError:
-                self.diagnostic.manager.halt_injectors()
-                logging.error("Zero TTF specified on file %s, injectors halted" \
-                        + self.filename)
-                break
-        self.timestamp = timestamp
+            if mttf <= 0:
+                logging.error("Zero TTF specified on file %s, injectors halted", self.filename)
+                return None
+            if index == 0 or index >= len(self.times):
+                return self.t0 + elapsed + hazard * mttf    # no further MTTF switches
+            segment = max(self.times[index] - elapsed, 0)
+            if hazard <= segment / mttf:
+                return self.t0 + elapsed + hazard * mttf
+            hazard -= segment / mttf
+            elapsed = max(elapsed, self.times[index])
+            mttf = float(self.mttfs[index])
+            index += 1
 
 
 class injectorManager(object):
-    ''' The injector manager spawns a thread from a list of diagnostics that 
-        manages a set of injectors, calculating and evaluating their probabilities
+    ''' The injector manager spawns a thread from a list of diagnostics that
+        draws the failure times of a set of injectors, keeps them in a timer heap
+        and sleeps until the next one is due
     '''
+    SWITCH, FAILURE = 0, 1     # kinds of heap events
+
     def __init__(self, diagnostics):
         self.injectors = []
         self.halt = False
+        self.wakeup = Event()
+        self.generation = 0     # identifies the current injector thread
         for i in diagnostics:
             self.injectors += i.injectors
-        self.min_Deltat = 0 # The minimum interval between probability evaluations
 
         # TODO: measurements
 
@@ -89,34 +99,60 @@ class injectorManager(object):
         self._spawn_injector_processor()
 
     def _spawn_injector_processor(self):
-        self.t = Thread(target=self.process_injectors)
+        self.generation += 1
+        self.t = Thread(target=self.process_injectors, args=[self.generation])
         self.t.daemon = True
         self.t.start()
 
+    def stop(self):
+        ''' Halts the injector thread '''
+        self.halt = True
+        self.wakeup.set()
+
     def reinit_injectors(self):
         ''' Spawn a new injector manager thread '''
         sleep(3) # TODO: give some time for the simulation to checkpoint
         self.halt = False
-        map(lambda x:x.new_timestamp(), self.injectors) 
+        self.wakeup.clear()
         self._spawn_injector_processor()
 
-    def process_injectors(self):
-        while True:
-            if self.halt:
-                break
-
-            map(lambda x:x.update(), self.injectors)
-            sleep(self.min_Deltat)
-            for i in self.injectors:
+    def _schedule(self, heap, seq, i, now):
+        ''' Pushes the next failure of injector i, unless it is disabled '''
+        if i.disabled:
+            return
+        when = i.next_failure(now)
+        if when is None:
+            self.stop()
+        else:
+            heappush(heap, (when, self.FAILURE, seq, i))
+
+    def process_injectors(self, generation):
+        # failure times are drawn anew on every run, as the TTF distributions are memoryless
+        heap = []
+        now = time()
+        for seq, i in enumerate(self.injectors):
+            for when in i.switch_times():
+                heappush(heap, (when, self.SWITCH, seq, i))
+            self._schedule(heap, seq, i, now)
+
+        while not self.halt and generation == self.generation and len(heap) > 0:
+            when, kind, seq, i = heap[0]
+            delay = when - time()
+            if delay > 0:
+                self.wakeup.wait(delay)
+                continue
+            heappop(heap)
+
+            if kind == self.SWITCH:
+                i.switch_mttf()
                 self.current_mttf = i.current_mttf
-                rand = random()
-                #print "rand: " + str(rand) + " probab: " + str(i.probability)
-                if rand < i.probability and not i.disabled:
-                    print "Injecting " + i.__class__.__name__
-                    logging.info("Injecting " + i.__class__.__name__)
-                    i.inject()
-                    break
-        self.halt = False
+            elif not i.disabled:
+                print "Injecting " + i.__class__.__name__
+                logging.info("Injecting " + i.__class__.__name__)
+                i.injections += 1
+                tracer.fault('inject ' + i.__class__.__name__)
+                i.inject()
+                self._schedule(heap, seq, i, time())
 
 class benchmarkInjector(injector):
     ''' Injects an RCCE process exit failure '''
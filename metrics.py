@@ -0,0 +1,170 @@
+import os
+import logging
+from time import sleep
+from threading import Thread
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+
+from config import safe_location, metrics_address, metrics_port, metrics_textfile, metrics_interval
+
+
+def directory_size(path):
+    ''' Returns the total size in bytes of the files under path '''
+    total = 0
+    for root, dirs, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.path.getsize(os.path.join(root, name))
+            except OSError:
+                pass    # removed while walking
+    return total
+
+
+class metricFamily(object):
+    ''' The samples of one metric in the Prometheus text exposition format '''
+
+    def __init__(self, name, kind, help):
+        self.name = name
+        self.kind = kind
+        self.help = help
+        self.samples = []
+
+    def add(self, value, suffix='', **labels):
+        if value is not None:
+            self.samples.append((self.name + suffix, labels, value))
+        return self
+
+    def render(self):
+        lines = ["# HELP %s %s" % (self.name, self.help), "# TYPE %s %s" % (self.name, self.kind)]
+        for name, labels, value in self.samples:
+            if len(labels) > 0:
+                name += '{' + ','.join('%s="%s"' % item for item in sorted(labels.items())) + '}'
+            lines.append("%s %r" % (name, float(value)))
+        return '\n'.join(lines)
+
+
+class metricsExporter(object):
+    ''' Exposes the state of a depman instance as Prometheus metrics. Metrics are
+        collected from the manager when they are requested, through an HTTP endpoint
+        and/or a textfile for the node exporter that is rewritten every interval seconds
+    '''
+
+    def __init__(self, manager, address=metrics_address, port=metrics_port,
+                 textfile=metrics_textfile, interval=metrics_interval):
+        self.manager = manager
+        self.textfile = textfile
+        self.interval = interval
+        self.server = None
+        if port is not None:
+            try:
+                self.server = HTTPServer((address, port), metricsHandler)
+                self.server.exporter = self
+                self._spawn(self.server.serve_forever)
+                logging.info("Metrics served on %s:%d", address, port)
+            except (OSError, IOError) as e:
+                logging.warning("Metrics endpoint could not be started: %s", e)
+        if textfile is not None:
+            self._spawn(self.write_textfile)
+
+    def _spawn(self, target):
+        t = Thread(target=target)
+        t.daemon = True
+        t.start()
+
+    def write_textfile(self):
+        while True:
+            try:
+                temp = self.textfile + '.tmp'
+                with open(temp, 'w') as f:
+                    f.write(self.render())
+                os.rename(temp, self.textfile)
+            except (OSError, IOError) as e:
+                logging.warning("Metrics textfile could not be written: %s", e)
+            sleep(self.interval)
+
+    def collect(self):
+        ''' Returns the metric families of the current state of the manager '''
+        dm = self.manager
+        families = []
+        def family(name, kind, help):
+            families.append(metricFamily(name, kind, help))
+            return families[-1]
+
+        estimate = dm.estimator.estimate()
+        mttf = family('depman_mttf_seconds', 'gauge', "MTTF estimate and its confidence interval bounds")
+        if estimate is not None:
+            mttf.add(estimate[0]).add(estimate[1], bound='low').add(estimate[2], bound='high')
+        family('depman_ttf_observations', 'gauge', "Observations of the MTTF estimator window").add(
+            len(dm.estimator.observations))
+        mttr = family('depman_mttr_seconds', 'gauge', "Mean time to repair")
+        if len(dm.mttr_values) > 0:
+            mttr.add(sum(dm.mttr_values) / len(dm.mttr_values))
+        family('depman_recoveries_total', 'counter', "Completed recoveries").add(len(dm.mttr_values))
+
+        family('depman_checkpoint_interval_steps', 'gauge', "Chosen checkpoint interval").add(
+            int(dm.exec_list[-1]))
+        family('depman_checkpoint_latency_seconds', 'gauge', "Estimated checkpoint latency").add(dm.latency)
+        family('depman_checkpoints', 'gauge', "Valid DUE checkpoints").add(len(dm.checkpoints))
+        family('depman_safe_location_bytes', 'gauge', "Size of the checkpoint store").add(
+            directory_size(safe_location))
+        family('depman_energy_joules_total', 'counter', "Board energy since startup").add(
+            dm.power.total_energy)
+
+        failures = family('depman_diagnostic_failures_total', 'counter', "Failures per diagnostic")
+        failed = family('depman_diagnostic_failed', 'gauge', "1 while a diagnostic is failed")
+        steps = family('depman_reader_simstep', 'gauge', "Last validated simulation step per output file")
+        lag_bytes = family('depman_reader_lag_bytes', 'gauge', "Output written and not validated yet")
+        lag_steps = family('depman_reader_lag_steps', 'gauge', "Estimated simulation steps behind the writer")
+        round_time = family('depman_pinger_round_seconds', 'gauge', "Duration of the last probe sweep")
+        for diagnostic in dm.diagnostics:
+            name = diagnostic.__class__.__name__
+            failures.add(diagnostic.failure_count, diagnostic=name)
+            failed.add(int(diagnostic.failed), diagnostic=name)
+            for reader in getattr(diagnostic, 'readers', []):
+                core = str(reader.line_processor.core)
+                behind, behind_steps = reader.lag()
+                steps.add(reader.line_processor.simstep, core=core)
+                lag_bytes.add(behind, core=core)
+                lag_steps.add(behind_steps, core=core)
+            if hasattr(diagnostic, 'round_time'):
+                round_time.add(diagnostic.round_time, diagnostic=name)
+
+        rates = family('depman_injector_rate', 'gauge', "Current injection rate per second")
+        injections = family('depman_injections_total', 'counter', "Injected failures")
+        if dm.fault_injection:
+            for injector in dm.injector.injectors:
+                name = injector.__class__.__name__
+                if injector.current_mttf > 0:
+                    rates.add(1.0 / injector.current_mttf, injector=name)
+                injections.add(injector.injections, injector=name)
+
+        durations = family('depman_countermeasure_seconds', 'summary', "Duration of the countermeasures")
+        for name, stats in sorted(dm.countermeasure_times.items()):
+            for quantile in ('p50', 'p95', 'p99'):
+                durations.add(stats.get(quantile), countermeasure=name, quantile='0.' + quantile[1:])
+            durations.add(stats.mean * len(stats), '_sum', countermeasure=name)
+            durations.add(len(stats), '_count', countermeasure=name)
+        return families
+
+    def render(self):
+        return '\n'.join(f.render() for f in self.collect()) + '\n'
+
+
+class metricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+        try:
+            body = self.server.exporter.render()
+        except Exception as e:
+            logging.exception("Metrics could not be collected")
+            self.send_error(500)
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logging.debug("metrics request: " + format, *args)
@@ -1,12 +1,21 @@
-from time import sleep
+from time import sleep, time
 import os
 import abc
 import logging
 import sys
+import struct
+import ctypes
+import ctypes.util
+from select import select
+from array import array
+from bisect import bisect_right
 from random import randrange
 from threading import Thread
-from subprocess import call, STDOUT
-from Queue import Queue
+
+from probes import create_probe
+from tracing import tracer
+from config import use_inotify, poll_interval, line_index_stride, line_index_suffix, \
+                   probe_timeout, probe_interval, probe_retry_interval, probe_retries
 
 '''  Interface
     monitors are meant to be subclassed by platform-specific diagnostics.
@@ -36,6 +45,31 @@ class lineProcessor(object):
     def break_condition(self, line):
         return False
 
+    def line_key(self, line):
+        ''' Returns the non-decreasing key of a line (e.g. its simulation step) that is
+            used to index the followed file, or None if the line cannot be indexed
+        '''
+        return None
+
+    def process_lines(self, lines, fatal=lambda line: True):
+        ''' Processes a chunk of lines in order and returns the indices of the lines that
+            did not pass assert_line. Processing stops at the first malformed line for
+            which fatal(line) is True, and at the first line for which process_line
+            returns False. Processors may override it with a batched implementation
+        '''
+        malformed = []
+        for i, line in enumerate(lines):
+            try:
+                self.assert_line(line)
+            except AssertionError:
+                malformed.append(i)
+                if fatal(line):
+                    break
+                continue
+            if self.process_line(line) is False:
+                break
+        return malformed
+
 
 ''' stdout_monitor objects spawn a thread that waits on the stdout of
     a target process and scans its lines through the abstract method process_line.
@@ -64,11 +98,12 @@ class stdoutMonitor(monitor):
 
     def scan_stdout(self):
         out = self.process.stdout
+        encoding = sys.stdout.encoding or sys.getdefaultencoding()  # None when stdout is not a tty
         try:
             for line in iter(out.readline, b''):
                 valid = True
 
-                line = line.decode(sys.stdout.encoding) 
+                line = line.decode(encoding)
                 if line != None:
                     valid = self.process_line(line)
 
@@ -95,13 +130,13 @@ class checkpointMonitor(stdoutMonitor):
         if line.find("R" + self.manager.cores[2][1:]) != 1:
             if line.find("Interval") != -1:
                 try:
-                    self.manager.intervals.append(float(line.split()[-1]))
+                    self.manager.intervals.add(float(line.split()[-1]))
                     return True
                 except (ValueError, TypeError) as e:
                     pass
             if line.find("Latency") != -1:
                 try:
-                    self.manager.latencies.append(float(line.split()[-1]))
+                    self.manager.latencies.add(float(line.split()[-1]))
                     return True
                 except (ValueError, TypeError) as e:
                     pass
@@ -109,81 +144,77 @@ class checkpointMonitor(stdoutMonitor):
 
 
 
-''' corePinger objects spawn a number of pinging threads and a controller thread
-    that ping a list of IPs periodically. The case where some IPs are unreachable
-    is handled by the abstract method handle_unreachables
+''' corePinger objects spawn a controller thread that probes a list of cores
+    concurrently through a single probe engine. Responsive cores are probed every
+    probe_interval seconds, while suspicious ones are retried every probe_retry_interval
+    seconds until they answer or miss probe_retries probes in a row. The case where
+    some cores are unreachable is handled by the abstract method handle_unreachables
 '''
 class corePinger(monitor):
 
-    def __init__(self, num_threads, cores):
+    def __init__(self, cores, probe=None):
         self.unreachables = []
         self.perm_unreachables = []
-        self._unreachables = []
-        self.num_threads = num_threads # number of threads for simultaneous pinging
-        self.core_q = Queue()    # job queue for target IPs
         self.cores = cores      # core names, not numbers
         self.hold_threads = False
-        self.pingers = self._spawn_pingers()
+        self.probe = probe or create_probe()
+        self.misses = {}        # consecutive missed probes per core
+        self.next_probe = {}    # time of the next probe per core
+        self.round_time = 0     # duration of the last probe sweep
         self.controller = self._spawn_controller()
 
     def _spawn_controller(self):
-        ''' Spawns the queue controller thread '''
+        ''' Spawns the probe controller thread '''
         t = Thread(target=self.controller)
         t.daemon = True
         t.start()
         return t
 
-    def _spawn_pingers(self):
-        ''' Spawns self.num_threads pinger threads '''
-        pingers = []
-        for i in range(self.num_threads):
-            t = Thread(target=self.pinger, args=[i])
-            t.daemon = True
-            t.start()
-            pingers.append(t)
-        return pingers
-
     def wait(self):
-        ''' blocks until the job queue is completely processed'''
+        ''' stops probing after the current sweep '''
         self.hold_threads = True
 
     def switch_cores(self, cores):
-        ''' change the list of cores to be pinged at the next iteration '''
+        ''' change the list of cores to be probed at the next iteration '''
         self.cores = cores
         self.unreachables = []
-        self._unreachables = []
+        self.misses = {}
+        self.next_probe = {}
         self.hold_threads = False
 
-    def _ping(self, ip):
-        return call("ping -c 1 -W 3 %s" % ip, shell=True,
-                   stdout=open('/dev/null', 'w'), stderr=STDOUT)
-
-    def pinger(self, i):
-        ''' Pinger threads block on the core_q until an IP is available to ping '''
-        while True:
-            ip = self.core_q.get()
-
-            if self._ping(ip) != 0 and self._ping(ip) != 0: # two pings
-                    self._unreachables.append(ip)
-            self.core_q.task_done()
-            sleep(0.5) # time between polls
-
     def controller(self):
-        ''' Controller threads manage the queue and perform
-            the handling of the list of unreachable cores
+        ''' Probes the cores that are due, updates their schedules and
+            handles the list of unreachable cores
         '''
         while True:
             while self.hold_threads:
                 sleep(0.5)
 
-            self._unreachables = []
-            for ip in self.cores:
-                self.core_q.put(ip)
-            self.core_q.join()
-            self.unreachables = self._unreachables[:]
+            cores = self.cores
+            if len(cores) == 0:
+                sleep(probe_interval)
+                continue
+            now = time()
+            due = [core for core in cores if self.next_probe.get(core, 0) <= now]
+            if len(due) == 0:
+                sleep(max(0, min(self.next_probe[core] for core in cores) - now))
+                continue
+
+            reached = self.probe.sweep(due, probe_timeout)
+            self.round_time = time() - now
+            for core in due:
+                if core in reached:
+                    self.misses[core] = 0
+                    self.next_probe[core] = now + probe_interval
+                else:
+                    self.misses[core] = self.misses.get(core, 0) + 1
+                    self.next_probe[core] = now + probe_retry_interval
+
+            unreachables = [core for core in cores if self.misses.get(core, 0) >= probe_retries]
             for core in self.perm_unreachables:
-                if core not in self.unreachables:
-                    self.unreachables.append(core)
+                if core not in unreachables:
+                    unreachables.append(core)
+            self.unreachables = unreachables
             if not self.hold_threads and not self.handle_unreachables():
                 self.hold_threads = True
 
@@ -192,9 +223,123 @@ class corePinger(monitor):
         return True
 
 
+class inotifyWatch(object):
+    ''' Minimal ctypes binding of the Linux inotify API for a single file.
+        Raises OSError if inotify is not supported by the platform
+    '''
+    IN_MODIFY = 0x00000002
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVE_SELF = 0x00000800
+    IN_DELETE_SELF = 0x00000400
+
+    mask = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVE_SELF | IN_DELETE_SELF
+    _event = struct.Struct('iIII')     # wd, mask, cookie, len
+    _libc = None
+
+    def __init__(self, filename):
+        if inotifyWatch._libc is None:
+            inotifyWatch._libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self.fd = self._libc.inotify_init()
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init failed")
+        self.wd = -1
+        self.rewatch(filename)
+
+    def rewatch(self, filename):
+        ''' (Re)attach the watch to filename, e.g. after the file was replaced '''
+        if self.wd >= 0:
+            self._libc.inotify_rm_watch(self.fd, self.wd)
+        self.wd = self._libc.inotify_add_watch(self.fd, filename, self.mask)
+        if self.wd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_add_watch failed for " + filename)
+
+    def wait(self, timeout):
+        ''' Blocks for up to timeout seconds and returns the OR-ed mask of
+            the events received, or 0 on timeout
+        '''
+        ready = select([self.fd], [], [], timeout)[0]
+        if not ready:
+            return 0
+        buf = os.read(self.fd, 4096)
+        mask = 0
+        pos = 0
+        while pos + self._event.size <= len(buf):
+            wd, event_mask, cookie, length = self._event.unpack_from(buf, pos)
+            mask |= event_mask
+            pos += self._event.size + length
+        return mask
+
+    def close(self):
+        os.close(self.fd)
+
+
+class lineIndex(object):
+    ''' Sparse map from line keys to the byte offsets of the lines in a file.
+        Keys and offsets are kept in two arrays, with at most one entry
+        every `stride` bytes
+    '''
+    _header = struct.Struct('qq')     # stride, number of entries
+
+    def __init__(self, stride=line_index_stride):
+        self.stride = stride
+        self.keys = array('l')
+        self.offsets = array('l')
+
+    def next_offset(self):
+        ''' The smallest offset for which a new entry will be accepted '''
+        if len(self.offsets) == 0:
+            return 0
+        return self.offsets[-1] + self.stride
+
+    def add(self, key, offset):
+        ''' Returns True if the entry was added to the index '''
+        if len(self.keys) > 0 and (key <= self.keys[-1] or offset < self.next_offset()):
+            return False
+        self.keys.append(key)
+        self.offsets.append(offset)
+        return True
+
+    def lookup(self, key):
+        ''' Offset of the last indexed line with a key lower or equal to key '''
+        i = bisect_right(self.keys, key)
+        if i == 0:
+            return 0
+        return self.offsets[i - 1]
+
+    def truncate(self, size):
+        ''' Drops the entries that lie beyond the end of a file of the given size '''
+        i = bisect_right(self.offsets, size - 1)
+        del self.keys[i:]
+        del self.offsets[i:]
+
+    def save(self, filename):
+        keys = self.keys[:]
+        offsets = self.offsets[:len(keys)]
+        with open(filename + '.tmp', 'wb') as f:
+            f.write(self._header.pack(self.stride, len(offsets)))
+            keys[:len(offsets)].tofile(f)
+            offsets.tofile(f)
+        os.rename(filename + '.tmp', filename)
+
+    @classmethod
+    def load(cls, filename):
+        ''' Returns the index stored in filename, or an empty index if there is none '''
+        try:
+            with open(filename, 'rb') as f:
+                stride, count = cls._header.unpack(f.read(cls._header.size))
+                index = cls(stride)
+                index.keys.fromfile(f, count)
+                index.offsets.fromfile(f, count)
+        except (IOError, EOFError, struct.error):
+            return cls()
+        return index
+
+
 class fileReader(monitor):
     ''' A fileReader object spawns a thread that reads a file 
-        when its mttime is modified and passes every line through a line processor 
+        when it is modified and passes every line through a line processor.
+        Modifications are signaled by inotify, or detected by mtime polling
+        where inotify is not available
     '''
 
     # filename to follow, and line processor to be used for each line
@@ -211,26 +356,67 @@ class fileReader(monitor):
                done = False
                logging.error("%s could not be opened", filename)
                sleep(0.1)
-        self._get_line_offsets()
-        try:
-            self.f.seek(self.line_offset[self.line_processor.simstep])
-        except IndexError:
-            self.f.seek(0)
+        self.line_index = lineIndex.load(filename + line_index_suffix)
+        self._seek_to_step()
         self.time = os.path.getmtime(self.filename)
         self._injectSDC = False
         self.temp_string = ""
         self.temp_saved = False
         self._spawn_follower()
 
-    def _get_line_offsets(self):
-        self.line_offset = []
-        offset = 0
-        for line in self.f:
-            self.line_offset.append(offset)
-            offset += len(line)
-        if len(self.line_offset) == 0:
-            self.line_offset.append(0)
-        self.f.seek(0)
+    def _seek_to_step(self):
+        ''' Seeks to the closest indexed line before the line processor's step.
+            Earlier lines that are read are skipped by the line processor
+        '''
+        self.line_index.truncate(os.fstat(self.f.fileno()).st_size)
+        self.f.seek(self.line_index.lookup(self.line_processor.simstep))
+        self._at_line_start = True
+
+    def _index_lines(self, text, base):
+        ''' Adds the complete lines of text, read from offset base, to the line index.
+            Only the lines that are due according to the index stride are parsed
+        '''
+        t = self.line_index.next_offset() - base
+        while True:
+            if t <= 0 and self._at_line_start:
+                start = 0
+            else:
+                start = text.find('\n', max(t, 1) - 1) + 1
+                if start == 0:
+                    break
+            end = text.find('\n', start)
+            if end == -1:
+                break
+            key = self.line_processor.line_key(text[start:end])
+            if key is not None and self.line_index.add(key, base + start):
+                t = self.line_index.next_offset() - base
+            else:
+                t = end + 1
+            if t <= start:
+                t = start + 1
+        if len(text) > 0:
+            self._at_line_start = text.endswith('\n')
+
+    def save_index(self):
+        ''' Stores the line index next to the followed file '''
+        try:
+            self.line_index.save(self.filename + line_index_suffix)
+        except (OSError, IOError) as e:
+            logging.warning("Line index of %s could not be saved: %s", self.filename, e)
+
+    def lag(self):
+        ''' Returns the number of bytes written to the file and not read yet, and an
+            estimate of the simulation steps they hold from the bytes per step read so far
+        '''
+        try:
+            offset = self.f.tell()
+            behind = max(os.fstat(self.f.fileno()).st_size - offset, 0)
+        except (OSError, IOError, ValueError) as e:
+            return 0, 0     # closed by wait()
+        simstep = self.line_processor.simstep
+        if offset == 0 or simstep <= 0:
+            return behind, None
+        return behind, int(behind * simstep / offset)
 
     def _spawn_follower(self):
         ''' Spawn a file follower thread '''
@@ -241,6 +427,7 @@ class fileReader(monitor):
     def wait(self):
         ''' Close file and let the follower thread exit '''
         self.fail = True
+        self.save_index()
         done = False
         while not done:
             try:
@@ -252,6 +439,54 @@ class fileReader(monitor):
         self.temp_saved = False
 
     def follow(self):
+        ''' Follow the file through inotify events, or through mtime polling
+            when inotify is disabled or unavailable on the platform
+        '''
+        watch = None
+        if use_inotify:
+            try:
+                watch = inotifyWatch(self.filename)
+            except (OSError, AttributeError) as e:
+                logging.warning("inotify unavailable for %s, polling instead: %s", self.filename, e)
+
+        if watch is None:
+            self._follow_poll()
+        else:
+            try:
+                self._follow_inotify(watch)
+            finally:
+                watch.close()
+
+    def _follow_inotify(self, watch):
+        ''' Blocks on the inotify descriptor and reads the appended bytes on every event.
+            The wait timeout only bounds how late the thread notices self.fail
+        '''
+        stale = False   # True once the watched file has been replaced
+        try:
+            # catch up with writes that happened before the watch was set up
+            if os.fstat(self.f.fileno()).st_size > self.f.tell():
+                self._read_appended()
+        except (OSError, IOError, ValueError) as e:
+            pass
+
+        while True:
+            if self.fail is True:
+                break
+
+            try:
+                if stale:
+                    self._reopen()
+                    watch.rewatch(self.filename)
+                    stale = False
+                mask = watch.wait(1)
+                if mask & (inotifyWatch.IN_DELETE_SELF | inotifyWatch.IN_MOVE_SELF):
+                    stale = True
+                elif mask:
+                    self._read_appended()
+            except (OSError, IOError, ValueError) as e:
+                sleep(0.7)
+
+    def _follow_poll(self):
         if (self.time == os.path.getmtime(self.filename)):
             sleep(0.4)  #wait for the first edit of the file
 
@@ -260,22 +495,37 @@ class fileReader(monitor):
                 break
 
             try:
-                if (self.time != os.path.getmtime(self.filename)):
-                    text = self.f.read()
-                    self.time = os.path.getmtime(self.filename)
-                    if len(text.splitlines()) == 0:
-                        self.f.close()
-                        self.f = open(self.filename, 'r')
-                        self._get_line_offsets()
-                        try:
-                            self.f.seek(self.line_offset[self.line_processor.simstep])
-                        except IndexError:
-                            self.f.seek(0)
-                    else:
-                        self.process_linelist(text.splitlines())
+                mtime = os.path.getmtime(self.filename)
+                if (self.time != mtime):
+                    self.time = mtime
+                    self._read_appended()
+                else:
+                    sleep(poll_interval)
             except (OSError, IOError, ValueError) as e:
                 sleep(0.7)
 
+    def _read_appended(self):
+        ''' Reads the bytes appended since the last read. If nothing was appended and
+            the file was truncated or replaced, it is reopened
+        '''
+        self.f.seek(0, os.SEEK_CUR)    # clear the EOF indicator of the previous read
+        base = self.f.tell()
+        text = self.f.read()
+        if len(text.splitlines()) == 0:
+            # events also arrive for data that was already read
+            st = os.stat(self.filename)
+            if st.st_ino != os.fstat(self.f.fileno()).st_ino or st.st_size < self.f.tell():
+                self._reopen()
+        else:
+            self._index_lines(text, base)
+            self.process_linelist(text.splitlines())
+            tracer.output_resumed(self.filename)
+
+    def _reopen(self):
+        self.f.close()
+        self.f = open(self.filename, 'r')
+        self._seek_to_step()
+
     def tobits(self, s):
         return map(int, ''.join([bin(ord(i)).lstrip('0b').rjust(8,'0') for i in s]))
 
@@ -285,10 +535,17 @@ class fileReader(monitor):
     def injectSDC(self):
         self._injectSDC = True
 
+    def corrupted(self, line):
+        ''' True if a malformed line is complete, rather than the start of a line
+            that is still being written
+        '''
+        return len(line.strip().split()) >= self.line_processor.expected_length() and list(line.strip())[-1] != '-'
+
     def process_linelist(self, lines):
         if len(lines) == 0 and self._injectSDC:
             self.line_processor.diagnostic.fail()
 
+        batch = []  # (position in lines, line) pairs to be validated as one chunk
         for counter, line in enumerate(lines):
             if self.fail:
                 return
@@ -316,22 +573,23 @@ class fileReader(monitor):
                     line = self.temp_string + line
                     self.temp_saved = False
 
-            if self.fail:
-                return
-
             if not self.line_processor.break_condition(line):
-                try:
-                    self.line_processor.assert_line(line)
-                    self.line_processor.process_line(line)
-                except AssertionError:
-                    ''' the last line of the lines list should be merged with the
-                        first line of the next read if the type does not match
-                    '''
-                    if len(line.strip().split()) >= self.line_processor.expected_length() and list(line.strip())[-1] != '-':
-                        print line
-                        self.line_processor.diagnostic.fail()
-                        self.fail = True
-                    elif counter == len(lines) - 1:
-                        self.temp_string = line
-                        self.temp_saved = True
-
+                batch.append((counter, line))
+
+        if self.fail:
+            return
+
+        malformed = self.line_processor.process_lines([line for counter, line in batch], self.corrupted)
+        for i in malformed:
+            counter, line = batch[i]
+            ''' the last line of the lines list should be merged with the
+                first line of the next read if the type does not match
+            '''
+            if self.corrupted(line):
+                print line
+                self.line_processor.diagnostic.fail()
+                self.fail = True
+                return
+            elif counter == len(lines) - 1:
+                self.temp_string = line
+                self.temp_saved = True
@@ -0,0 +1,114 @@
+import sys
+import logging
+from time import time
+from threading import Thread, Condition
+
+from tracing import tracer, STEPS
+
+
+class plannedStep(object):
+    ''' A step of a countermeasure. It runs once the steps it requires, named within
+        its countermeasure, have succeeded and none of its resources is held by a
+        running step. Unless overlap is set, it also requires every step of the
+        countermeasures before its own in the procedure. The action returns True
+        on success
+    '''
+
+    def __init__(self, name, action, requires=(), resources=(), overlap=False):
+        self.name = name
+        self.action = action
+        self.requires = requires
+        self.resources = resources
+        self.overlap = overlap
+
+
+class countermeasurePlanner(object):
+    ''' Runs a sequence of countermeasures as a dependency graph of their steps,
+        starting every step as soon as it is allowed to, on its own thread. Once a
+        step fails no new step is started, and the sequence fails as it would if
+        the countermeasures were performed one after the other
+    '''
+
+    def __init__(self, countermeasures):
+        self.countermeasures = countermeasures
+        self.steps = []         # (key, step) pairs in procedure order
+        self.requires = {}      # key -> keys of the required steps
+        self.times = {}         # key -> (start, end) of the performed steps
+        earlier = []
+        for i, cm in enumerate(countermeasures):
+            own = []
+            for step in cm.steps():
+                key = (i, step.name)
+                self.steps.append((key, step))
+                self.requires[key] = set((i, name) for name in step.requires)
+                if not step.overlap:
+                    self.requires[key].update(earlier)
+                own.append(key)
+            earlier.extend(own)
+
+    def run(self):
+        ''' Performs the steps and returns True if all of them succeeded '''
+        cond = Condition()
+        pending = list(self.steps)
+        done = set()
+        held = set()
+        lanes = set()   # trace lanes of the running steps
+        self.failed = False
+        self.error = None
+
+        def perform(key, step, lane):
+            start = time()
+            try:
+                ok = step.action()
+            except Exception:
+                ok = False
+                self.error = self.error or sys.exc_info()
+            end = time()
+            with cond:
+                self.record(key, start, end, lane)
+                held.difference_update(step.resources)
+                lanes.discard(lane)
+                if ok:
+                    done.add(key)
+                else:
+                    logging.warning("Countermeasure step %s failed", step.name)
+                    self.failed = True
+                cond.notify()
+
+        with cond:
+            while True:
+                if not self.failed:
+                    for key, step in list(pending):
+                        if self.requires[key] <= done and held.isdisjoint(step.resources):
+                            pending.remove((key, step))
+                            held.update(step.resources)
+                            lane = min(set(range(len(lanes) + 1)) - lanes)
+                            lanes.add(lane)
+                            t = Thread(target=perform, args=(key, step, lane))
+                            t.daemon = True
+                            t.start()
+                if len(lanes) == 0:
+                    break
+                cond.wait()
+
+        if self.error is not None:
+            raise self.error[0], self.error[1], self.error[2]
+        return not self.failed and len(pending) == 0
+
+    def record(self, key, start, end, lane=0):
+        self.times[key] = (start, end)
+        tracer.complete(key[1], start, end, tid=STEPS + lane,
+                        countermeasure=self.countermeasures[key[0]].__class__.__name__)
+
+    def durations(self):
+        ''' Returns the (name, seconds) pairs of the countermeasures that were started,
+            from the start of their first step to the end of their last one
+        '''
+        result = []
+        for i, cm in enumerate(self.countermeasures):
+            times = [t for key, t in self.times.items() if key[0] == i]
+            if len(times) > 0:
+                start, end = min(t[0] for t in times), max(t[1] for t in times)
+                tracer.complete(cm.__class__.__name__, start, end)
+                result.append((cm.__class__.__name__, end - start))
+        return result
@@ -0,0 +1,109 @@
+import re
+import logging
+from time import time, sleep
+from threading import Thread, Lock
+from subprocess import Popen, PIPE
+from collections import deque
+
+from monitors import monitor
+from config import power_command, power_sample_interval, power_buffer_size, power_flush_interval
+
+_value = re.compile(r'(-?\d+(?:\.\d+)?)\s*(mV|V|mA|A)\b')
+
+def parse_reading(text):
+    ''' Returns the first voltage and current of a status line, in V and A, or None '''
+    volts = amps = None
+    for number, unit in _value.findall(text):
+        value = float(number) / (1000 if unit[0] == 'm' else 1)
+        if unit[-1] == 'V' and volts is None:
+            volts = value
+        elif unit[-1] == 'A' and amps is None:
+            amps = value
+    if volts is None or amps is None:
+        return None
+    return volts, amps
+
+
+class powerSampler(monitor):
+    ''' A powerSampler object spawns a thread that runs a power status command every
+        interval seconds and parses its voltage and current. The last capacity samples
+        are kept in a ring buffer for energy queries, the total energy is integrated as
+        samples arrive, and samples are appended as CSV lines of time, voltage, current
+        and power to filename every flush_interval seconds
+    '''
+
+    def __init__(self, command=power_command, filename=None, interval=power_sample_interval,
+                 capacity=power_buffer_size, flush_interval=power_flush_interval):
+        self.command = command
+        self.interval = interval
+        self.flush_interval = flush_interval
+        self.samples = deque([], capacity)  # (time, volts, amps, watts) tuples
+        self.pending = []                   # samples not flushed yet
+        self.total_energy = 0.0             # in Joules, since the first sample
+        self.lock = Lock()
+        self.stopped = False
+        self.out = open(filename, 'w') if filename is not None else None
+        if self.out is not None:
+            self.out.write("time,voltage,current,power\n")
+        self.t = Thread(target=self.sample_loop)
+        self.t.daemon = True
+        self.t.start()
+
+    def read(self):
+        ''' Runs the status command once and returns its (volts, amps) reading or None '''
+        try:
+            output = Popen(self.command, shell=True, stdout=PIPE).communicate()[0]
+        except OSError as e:
+            logging.warning("Power status command failed: %s", e)
+            return None
+        reading = parse_reading(output)
+        if reading is None:
+            logging.warning("Power status could not be parsed: %s", output.strip())
+        return reading
+
+    def add(self, t, volts, amps):
+        watts = volts * amps
+        with self.lock:
+            if len(self.samples) > 0:
+                last_t, last_watts = self.samples[-1][0], self.samples[-1][3]
+                self.total_energy += (t - last_t) * (watts + last_watts) / 2
+            self.samples.append((t, volts, amps, watts))
+            self.pending.append((t, volts, amps, watts))
+
+    def sample_loop(self):
+        last_flush = time()
+        while not self.stopped:
+            start = time()
+            reading = self.read()
+            if reading is not None:
+                self.add(start, *reading)
+            if time() - last_flush >= self.flush_interval:
+                self.flush()
+                last_flush = time()
+            sleep(max(self.interval - (time() - start), 0))
+
+    def flush(self):
+        with self.lock:
+            pending, self.pending = self.pending, []
+        if self.out is not None and len(pending) > 0:
+            self.out.write(''.join("%.3f,%.4f,%.4f,%.4f\n" % sample for sample in pending))
+            self.out.flush()
+
+    def energy(self, start, end):
+        ''' Returns the energy in Joules between two times by trapezoidal integration of
+            the buffered samples, holding the power of the nearest sample at the bounds.
+            Returns None if no sample precedes end
+        '''
+        with self.lock:
+            points = [(t, w) for t, v, a, w in self.samples if start < t < end]
+            before = [(t, w) for t, v, a, w in self.samples if t <= start]
+        if len(points) == 0 and len(before) == 0:
+            return None
+        points.insert(0, (start, before[-1][1] if len(before) > 0 else points[0][1]))
+        points.append((end, points[-1][1]))
+        return sum((t2 - t1) * (w1 + w2) / 2 for (t1, w1), (t2, w2) in zip(points, points[1:]))
+
+    def wait(self):
+        ''' Stops sampling and flushes the remaining samples '''
+        self.stopped = True
+        self.flush()
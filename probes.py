@@ -0,0 +1,166 @@
+import os
+import abc
+import errno
+import socket
+import struct
+import logging
+from select import select
+from time import time
+
+from config import devel, probe_method, probe_port, boot_probe_port
+
+
+''' Interface
+    probes check the reachability of a set of hosts concurrently, from a single
+    thread, and return once every host answered or the timeout expired
+'''
+class probe(object):
+    __metaclass__ = abc.ABCMeta
+
+    def __init__(self):
+        self.addresses = {}
+
+    def resolve(self, host):
+        ''' Returns the IP of a host, or None if it cannot be resolved. Resolutions are cached '''
+        if host not in self.addresses:
+            try:
+                self.addresses[host] = socket.gethostbyname(host)
+            except socket.error:
+                logging.warning("Host %s could not be resolved", host)
+                return None
+        return self.addresses[host]
+
+    @abc.abstractmethod
+    def sweep(self, hosts, timeout):
+        ''' Returns the set of hosts that answered within timeout seconds '''
+        return set()
+
+
+class tcpProbe(probe):
+    ''' Considers a host reachable if it accepts or, unless listening is required,
+        actively refuses a TCP connection
+    '''
+
+    def __init__(self, port=probe_port, listening=False):
+        probe.__init__(self)
+        self.port = port
+        self.answers = (0,) if listening else (0, errno.ECONNREFUSED)
+
+    def sweep(self, hosts, timeout):
+        deadline = time() + timeout
+        pending = {}
+        reached = set()
+        for host in hosts:
+            ip = self.resolve(host)
+            if ip is None:
+                continue
+            s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            s.setblocking(0)
+            err = s.connect_ex((ip, self.port))
+            if err in self.answers:
+                reached.add(host)
+                s.close()
+            elif err in (errno.EINPROGRESS, errno.EWOULDBLOCK):
+                pending[s] = host
+            else:
+                s.close()
+
+        while pending and time() < deadline:
+            writable = select([], pending.keys(), [], deadline - time())[1]
+            for s in writable:
+                if s.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR) in self.answers:
+                    reached.add(pending[s])
+                del pending[s]
+                s.close()
+        for s in pending:
+            s.close()
+        return reached
+
+
+class icmpProbe(probe):
+    ''' Sends one ICMP echo request to every host over a raw socket and collects
+        the replies. Requires root privileges
+    '''
+    ECHO_REQUEST = 8
+    ECHO_REPLY = 0
+
+    def __init__(self):
+        probe.__init__(self)
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_RAW, socket.getprotobyname('icmp'))
+        self.ident = os.getpid() & 0xffff
+        self.sequence = 0
+
+    def _checksum(self, data):
+        if len(data) % 2:
+            data += '\0'
+        total = sum(struct.unpack('!%dH' % (len(data) / 2), data))
+        total = (total >> 16) + (total & 0xffff)
+        total += total >> 16
+        return ~total & 0xffff
+
+    def _packet(self, sequence):
+        header = struct.pack('!BBHHH', self.ECHO_REQUEST, 0, 0, self.ident, sequence)
+        payload = 'depman'
+        checksum = self._checksum(header + payload)
+        return struct.pack('!BBHHH', self.ECHO_REQUEST, 0, checksum, self.ident, sequence) + payload
+
+    def sweep(self, hosts, timeout):
+        deadline = time() + timeout
+        waiting = {}    # sequence number -> host
+        for host in hosts:
+            ip = self.resolve(host)
+            if ip is None:
+                continue
+            self.sequence = (self.sequence + 1) & 0xffff
+            try:
+                self.socket.sendto(self._packet(self.sequence), (ip, 0))
+                waiting[self.sequence] = host
+            except socket.error as e:
+                logging.debug("Echo request to %s failed: %s", host, e)
+
+        reached = set()
+        while waiting and time() < deadline:
+            if not select([self.socket], [], [], deadline - time())[0]:
+                break
+            packet = self.socket.recv(1024)
+            header_length = (ord(packet[0]) & 0x0f) * 4    # skip the IP header
+            icmp_type, code, checksum, ident, sequence = struct.unpack('!BBHHH', packet[header_length:header_length + 8])
+            if icmp_type == self.ECHO_REPLY and ident == self.ident and sequence in waiting:
+                reached.add(waiting.pop(sequence))
+        return reached
+
+
+class localProbe(probe):
+    ''' Stand-in probe for development environments and tests:
+        every host is reachable unless it has been added to the down set
+    '''
+
+    def __init__(self, down=None):
+        probe.__init__(self)
+        self.down = set(down or [])
+
+    def sweep(self, hosts, timeout):
+        return set(hosts) - self.down
+
+
+def create_probe(method=probe_method):
+    ''' Returns the probe selected in config. 'auto' uses ICMP when privileged
+        and TCP connections otherwise
+    '''
+    if method == 'local' or (method == 'auto' and devel):
+        return localProbe()
+    if method == 'icmp' or (method == 'auto' and os.geteuid() == 0):
+        try:
+            return icmpProbe()
+        except socket.error as e:
+            logging.warning("ICMP probes unavailable, using TCP: %s", e)
+    return tcpProbe()
+
+
+def create_readiness_probe(method=probe_method):
+    ''' Returns the probe that tells when a booted core is ready: its login port
+        accepts connections, which answering pings or refusing them does not ensure
+    '''
+    if method == 'local' or (method == 'auto' and devel):
+        return localProbe()
+    return tcpProbe(boot_probe_port, listening=True)
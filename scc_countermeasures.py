@@ -1,18 +1,31 @@
 import abc
+import os
+import random
 import logging
 from time import sleep, time
-from subprocess import call, check_output
+from subprocess import call
 from monitors import corePinger
-from config import sim_dump_location, safe_location, devel
+from probes import create_readiness_probe
+from planner import plannedStep, countermeasurePlanner
+from checkpoints import checksumError
+from config import sim_dump_location, safe_location, devel, line_index_suffix, \
+                   probe_timeout, boot_backoff_initial, boot_backoff_max, reboot_groups
 import infoli_diagnostics
+from tracing import tracer
 
 class countermeasure(object):
-    ''' Countermeasure class '''
+    ''' Countermeasure class. Countermeasures are made of planned steps, so that
+        the steps of a procedure can be run concurrently
+    '''
     __metaclass__ = abc.ABCMeta
 
     @abc.abstractmethod
+    def steps(self):
+        ''' Returns the list of plannedStep objects of the countermeasure '''
+        return []
+
     def perform(self):
-        return
+        return countermeasurePlanner([self]).run()
 
 
 ''' defines an ordering among the different countermeasures, based on MTTR '''
@@ -23,33 +36,40 @@ countermeasure_enum = {
 }
 
 
-def wait_for_cores(core_names, timeout):
-    ''' Utility function that blocks until a set of cores is available 
-        or until the timeout is reached
+def wait_for_cores(core_names, timeout, probe=None):
+    ''' Utility function that blocks until every core of core_names is ready
+        or until the timeout is reached. The cores that are still booting are
+        probed together, with an exponential backoff and jitter between sweeps.
+        Returns the boot time of every core in seconds, or None on timeout
     '''
-    if devel:
-        return True
-
+    probe = probe or create_readiness_probe()
     t0 = time()
-    available_cores = 0
-
-    while available_cores < len(core_names):
-        status = check_output(['sccBoot', '-s'])
-
-        if status[-11:-8] == "All":
-            available_cores = 48
-        elif status[-10:-8] == "No":
-            available_cores = 0
-        else:
-            available_cores = int(status[-10:-8])
-
-        if time() - t0 > timeout:
-            logging.error("Boot Timeout exceeded for %s cores", len(core_names))
-            return False
-    sleep(10)
-    status = check_output(['sccBoot', '-s'])
-    print status
-    return True
+    pending = set(core_names)
+    boot_times = {}
+    delay = boot_backoff_initial
+
+    while True:
+        remaining = timeout - (time() - t0)
+        for core in probe.sweep(sorted(pending), max(min(probe_timeout, remaining), 0)):
+            boot_times[core] = time() - t0
+            tracer.complete('boot ' + core, t0, time())
+        pending -= set(boot_times)
+        if len(pending) == 0:
+            break
+
+        remaining = timeout - (time() - t0)
+        if remaining <= 0:
+            logging.error("Boot Timeout exceeded for %d of %d cores: %s", len(pending),
+                          len(core_names), ' '.join(sorted(pending)))
+            return None
+        sleep(min(delay / 2 + random.uniform(0, delay / 2), remaining))
+        delay = min(delay * 2, boot_backoff_max)
+
+    if len(boot_times) > 0:
+        logging.info("%d cores ready in %.1f s, slowest %s after %.1f s", len(boot_times),
+                     time() - t0, *max(boot_times.items(), key=lambda item: item[1]))
+        logging.debug("Boot times: %s", ', '.join("%s %.1f s" % item for item in sorted(boot_times.items())))
+    return boot_times
 
 
 def boot_linux():
@@ -66,58 +86,133 @@ def boot_linux():
     return True
 
 
+def sdc_failed(manager):
+    ''' infoli-specific: True if the SDC detection diagnostic has failed '''
+    return any(isinstance(x, infoli_diagnostics.infoliOutputDivergence) for x \
+               in manager.failed_diagnostics())
+
+
+def kept_checkpoints(manager):
+    ''' Returns the sorted checkpoints kept on a restart: only the newest one before
+        min_step is kept, and only the oldest one remaining after an SDC, since newer
+        ones may hold corrupted state
+    '''
+    checkpoints = sorted(manager.checkpoints)
+    #TODO: min_step is infoli-specific
+    while len(checkpoints) >= 2 and checkpoints[1] < manager.min_step:
+        checkpoints.pop(0)
+    if sdc_failed(manager):
+        return checkpoints[:1]
+    return checkpoints
+
+
+def restart_checkpoint(manager):
+    ''' Returns the step of the checkpoint the simulation restarts from, or None '''
+    checkpoints = kept_checkpoints(manager)
+    return checkpoints[-1] if len(checkpoints) > 0 else None
+
+
+def checkpoint_files(manager, step):
+    ''' Returns the files of the checkpoint of step restored on a restart '''
+    files = []
+    for i in range(manager.num_cores):
+        files.append('ckptFile%d.bin' %i)
+        files.append('InferiorOlive_Output%d.txt' %i)
+        if manager.store.contains(step, files[-1] + line_index_suffix):
+            files.append(files[-1] + line_index_suffix)
+    return files
+
+
 class restartSimulation(countermeasure):
-    """ Restarts the simulation """
+    """ Restarts the simulation. The checkpoint is restored and the hostfile written
+        while the countermeasures before it, such as a reboot, are still running
+    """
     __name__ = 'restartSimulation'
 
     def __init__(self, manager):
         self.manager = manager
+        self.checkpoint = None
 
     def delete_checkpoint(self, step):
-        call(['rm', '-rf', safe_location + str(step)])
+        self.manager.store.delete(step)
+        self.manager.catalog.deleted(step)
         print "Discarding checkpoint at step " + str(step)
         logging.info("Discarding checkpoints at step " + str(step))
 
-    def perform(self):
+    def select_checkpoint(self):
         self.manager.restarted = True
 
         logging.info("performing the Restart Simulation countermeasure") #DEBUG
         self.manager.checkpoints = sorted(self.manager.checkpoints) 
         print self.manager.checkpoints
-        #TODO: min_step is infoli-specific
-        while len(self.manager.checkpoints) >= 2 and \
-                    self.manager.checkpoints[1] < self.manager.min_step:    
-            self.delete_checkpoint(self.manager.checkpoints.pop(0))
-
-        # infoli-specific: check if the SDC detection diagnostic has failed
-        if any(isinstance(x, infoli_diagnostics.infoliOutputDivergence) for x \
-                   in self.manager.failed_diagnostics()):   
-            checkpoint = self.manager.checkpoints[0]
-            for step in sorted(self.manager.checkpoints)[1:]:
+        kept = kept_checkpoints(self.manager)
+        for step in self.manager.checkpoints:
+            if step not in kept:
                 self.delete_checkpoint(step)
-            self.manager.checkpoints = [self.manager.checkpoints[0]]
+        self.manager.checkpoints = kept
+        checkpoint = restart_checkpoint(self.manager)
 
-            if checkpoint > self.manager.min_step:
-                #FUTURE-TODO: eradicate this case
-                logging.warning("Could not locate a checkpoint before the SDC detector. The file should be rechecked")
-        else:
-            checkpoint = max(self.manager.checkpoints)
+        if sdc_failed(self.manager) and checkpoint > self.manager.min_step:
+            #FUTURE-TODO: eradicate this case
+            logging.warning("Could not locate a checkpoint before the SDC detector. The file should be rechecked")
 
         print "Restarting from simulation step " + str(checkpoint)
         logging.info("Restarting from simulation step " + str(checkpoint))
+        self.checkpoint = checkpoint
+        return True
 
+    def restore_checkpoint(self):
+        # the line index must describe the restored output file, or not exist at all
+        for i in range(self.manager.num_cores):
+            index = sim_dump_location + 'InferiorOlive_Output%d.txt' % i + line_index_suffix
+            if os.path.exists(index):
+                os.remove(index)
+
+        files = checkpoint_files(self.manager, self.checkpoint)
+        if self.manager.stager.swap(self.checkpoint, files, update=True):
+            logging.info("Staged checkpoint of step %d moved into place", self.checkpoint)
+            return True
+        # Copy safe checkpoints, falling back to older ones if a checkpoint is damaged
+        update = True
+        while True:
+            try:
+                if self.manager.store.restore(self.checkpoint, sim_dump_location, files, update):
+                    return True
+                logging.error("Checkpoint of step %d could not be restored", self.checkpoint)
+                return False
+            except checksumError as e:
+                logging.error("Checkpoint of step %d is damaged: %s", self.checkpoint, e)
+            older = [step for step in self.manager.checkpoints if step < self.checkpoint]
+            if len(older) == 0:
+                return False
+            self.delete_checkpoint(self.checkpoint)
+            self.manager.checkpoints.remove(self.checkpoint)
+            self.checkpoint = max(older)
+            self.manager.prev_globalmax = self.checkpoint   # the steps after it are checkpointed again
+            logging.warning("Falling back to the checkpoint of step %d", self.checkpoint)
+            files = checkpoint_files(self.manager, self.checkpoint)
+            update = False  # files of the damaged checkpoint may have been restored
+
+    def write_hostfile(self):
+        self.manager.create_hostfile(self.manager.cores)
+        return True
+
+    def launch(self):
         with self.manager.lock:
-            # Copy safe checkpoints
-            for i in range(self.manager.num_cores):
-                call( ['cp', '-f', '-u', safe_location + str(checkpoint) + '/ckptFile%d.bin' %i, sim_dump_location])
-                call( ['cp', '-f', '-u', safe_location + str(checkpoint) + '/InferiorOlive_Output%d.txt' %i, sim_dump_location]) 
             self.manager.rccerun([self.manager.restart_exec] + self.manager.exec_list[1:], False)   # use False to avoid piping stdout for diagnostics - useful for measurements
         logging.info("Restart Simulation countermeasure completed")
         return True
 
+    def steps(self):
+        return [plannedStep('select checkpoint', self.select_checkpoint, overlap=True),
+                plannedStep('restore checkpoint', self.restore_checkpoint, ['select checkpoint'],
+                            ['dump directory'], overlap=True),
+                plannedStep('write hostfile', self.write_hostfile, overlap=True),
+                plannedStep('launch simulation', self.launch, ['restore checkpoint', 'write hostfile'])]
+
 
 class coreReboot(countermeasure):
-    """ Reboots a list of cores """
+    """ Reboots a list of cores. Disjoint groups of tiles are reset concurrently """
     __name__ = 'coreReboot'
 
     def __init__(self, reboot_cores, all_cores):
@@ -125,22 +220,41 @@ class coreReboot(countermeasure):
         self.cores = map(lambda x : x[3:], reboot_cores) # strip the 'rck' prefix
         self.all_cores = all_cores
 
-    def perform(self):
+    def groups(self):
+        ''' Splits the cores into at most reboot_groups groups of whole tiles '''
+        tiles = sorted(set(int(core) / 2 for core in self.cores))
+        groups = [[] for i in range(min(reboot_groups, len(tiles)))]
+        for i, tile in enumerate(tiles):
+            groups[i * len(groups) / len(tiles)].append(tile)
+        return [(group, sorted(core for core in self.cores if int(core) / 2 in group)) for group in groups]
+
+    def reset(self, cores, first=False):
+        if first:
+            logging.info("Core Reboot countermeasure started for %d cores", len(self.cores))
         if devel:
             ex = 'echo'
         else:
             ex = 'sccReset'
-        logging.info("Core Reboot countermeasure started for %d cores", len(self.cores))
-        call( [ex] + ['-p'] + self.cores)  # Are both -p and -r needed?
-        call( [ex] + ['-r'] + self.cores)
-        if not boot_linux():
-            return False
+        call( [ex] + ['-p'] + cores)  # Are both -p and -r needed?
+        call( [ex] + ['-r'] + cores)
+        return True
+
+    def wait(self):
         logging.info("Waiting for response from %d cores", len(self.all_cores))
-        if not wait_for_cores(self.all_cores, 180):
+        if wait_for_cores(self.all_cores, 180) is None:
             return False
         logging.info("Core Reboot countermeasure completed")
         return True
 
+    def steps(self):
+        resets = []
+        for tiles, cores in self.groups():
+            name = 'reset rck' + cores[0] + ('-rck' + cores[-1] if len(cores) > 1 else '')
+            resets.append(plannedStep(name, lambda cores=cores, first=len(resets) == 0: self.reset(cores, first),
+                                      resources=['tile %d' % tile for tile in tiles]))
+        return resets + [plannedStep('boot linux', boot_linux, [step.name for step in resets], ['board']),
+                         plannedStep('wait for cores', self.wait, ['boot linux'])]
+
 
 class platformReinitialization(countermeasure):
     """ Reinitializes the SCC board """
@@ -149,7 +263,7 @@ class platformReinitialization(countermeasure):
     def __init__(self, expected_cores):
         self.expected_cores = expected_cores
 
-    def perform(self):
+    def reinitialize(self):
         logging.info("Reinitializing the SCC board")
         if devel:
             ret = call(['echo', '-i', 'Tile533_Mesh800_DDR800']) #devel
@@ -158,11 +272,16 @@ class platformReinitialization(countermeasure):
         if ret != 0:
             logging.warning("sccBmc returned exit code %d during platform reinitialization", ret)
             return False
-        if not boot_linux():
-            return False
+        return True
+
+    def wait(self):
         logging.info("Waiting for response from %d cores", len(self.expected_cores))
-        if not wait_for_cores(self.expected_cores, 180):
+        if wait_for_cores(self.expected_cores, 180) is None:
             return False
-
         logging.info("Platform Reinitialization countermeasure completed")
         return True
+
+    def steps(self):
+        return [plannedStep('reinitialize board', self.reinitialize, resources=['board']),
+                plannedStep('boot linux', boot_linux, ['reinitialize board'], ['board']),
+                plannedStep('wait for cores', self.wait, ['boot linux'])]
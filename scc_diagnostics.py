@@ -4,7 +4,7 @@ import sys
 from threading import Lock
 from monitors import monitor, checkpointMonitor, corePinger, fileReader, lineProcessor
 from injectors import processExitInjector, coreShutdownInjector, coreFailureInjector, benchmarkInjector
-from core_allocator import allocate_tasks
+from tracing import tracer
 
 
 """ Diagnostics Interface """
@@ -15,6 +15,7 @@ class diagnostic(object):
 
     def __init__(self):
         self.failed = False
+        self.failure_count = 0
         self.lock = Lock()
 
     def fail(self):
@@ -22,6 +23,9 @@ class diagnostic(object):
             if not self.failed:
                 logging.error("%s diagnostic failed", self.__class__.__name__)
                 self.failed = True
+                self.failure_count += 1
+                tracer.failure_detected(self.__class__.__name__)
+                self.manager.report(self, 'failed')
             if not self.manager.stopped:
                 self.manager.stop()
 
@@ -35,6 +39,10 @@ class diagnostic(object):
     def completed(self):
         return True
 
+    def progress(self):
+        ''' Returns how far the diagnostic got towards completion, None if unknown '''
+        return None
+
     @abc.abstractmethod
     def reinitialize(self):
         return
@@ -101,11 +109,12 @@ class processExit(checkpointMonitor, diagnostic):
 
 
 class coreReachability(corePinger, diagnostic):
-    def __init__(self, manager, num_threads):
+    def __init__(self, manager, probe=None):
         self.manager = manager
-        corePinger.__init__(self, num_threads, self.manager.cores)
+        corePinger.__init__(self, self.manager.cores, probe)
         diagnostic.__init__(self)
         self.injectors = [coreShutdownInjector(self), coreFailureInjector(self)]
+        self.prefetch_allocations()
 
     def handle_unreachables(self):
         if len([core for core in self.unreachables if core in self.manager.cores]) > 0:
@@ -119,29 +128,45 @@ class coreReachability(corePinger, diagnostic):
     def reinitialize(self):
         self.switch_cores(self.manager.cores)
 
+    def degraded_tasks(self, available):
+        ''' Returns the number of tasks to run on a number of available cores '''
+        # TODO: infoli-specific
+        infoli_core_numbers = reversed([2,3,4,6,8,12,16,24])
+        for i in infoli_core_numbers:
+            if available >= i:
+                return i
+        return 1
+
+    def prefetch_allocations(self):
+        ''' Precomputes in the background the allocations that follow the loss of
+            any one of the cores in use
+        '''
+        scenarios = []
+        for core in self.manager.cores:
+            cores = [x for x in self.manager.initial_cores if x != core]
+            scenarios.append((self.degraded_tasks(len(cores)), cores))
+        self.manager.allocations.prefetch(scenarios)
+
     def degrade(self):
         ''' Scratch the failing cores and use a thermal-aware placement of the subset of cores.
         It is assumed that the simulator began with a divisor of 48 as the number of cores
         '''
         max_cores = self.manager.initial_cores
         self.manager.initial_cores = [x for x in max_cores if x not in self.unreachables] # scratch out unusable cores
-        
-        # TODO: infoli-specific
-        infoli_core_numbers = reversed([2,3,4,6,8,12,16,24])
-        new_tasks = 1
-        for i in infoli_core_numbers:
-            if len(self.manager.initial_cores) >= i:
-                new_tasks = i
-                break
 
-        self.manager.change_cores(allocate_tasks(new_tasks, self.manager.initial_cores))
+        new_tasks = self.degraded_tasks(len(self.manager.initial_cores))
+        self.manager.change_cores(self.manager.allocations.lookup(new_tasks, self.manager.initial_cores))
         logging.info("Reducing number of cores to %d", new_tasks)
+        self.prefetch_allocations()
 
     def fail(self):
         with self.lock:
             if not self.failed:
                 logging.error("%s diagnostic failed", self.__class__.__name__)
                 self.failed = True
+                self.failure_count += 1
+                tracer.failure_detected(self.__class__.__name__)
+                self.manager.report(self, 'failed')
             if not self.manager.stopped:
                 prev_cores = self.manager.cores
                 new_cores = [x for x in prev_cores if x not in self.unreachables]
@@ -0,0 +1,604 @@
+# Virtual-time simulator for depman recovery policies
+#
+# Drives the real depman policy code (event_loop, determine_countermeasures, the
+# checkpoint interval optimization and the allocate_tasks degradation) on a virtual
+# clock. The SCC tools and the simulation are replaced by models with configurable
+# latencies, and failures are read from a trace or drawn from an exponential TTF.
+#
+# usage: python simulator.py [options] [trace]
+# trace lines: <virtual time in seconds> <sdc|exit|core|corefail> [core name]
+
+import sys
+import os
+import json
+import random
+import logging
+from optparse import OptionParser
+from collections import deque
+from threading import Lock
+from Queue import Queue
+from time import time as wall_time
+
+import depman as depman_module
+import scc_countermeasures
+import tracing
+from depman import depman
+from core_allocator import allocationCache
+from planner import countermeasurePlanner
+from catalog import checkpointCatalog
+from scc_diagnostics import diagnostic, processExit, coreReachability
+from infoli_diagnostics import infoliOutputDivergence
+from config import rccerun_path, moving_avg_N
+
+''' Default latencies of the models, in virtual seconds '''
+default_latencies = {
+    'kill': 2,              # killfoli and SIGKILL of the simulation
+    'startup': 3,           # rccerun until the first simulation step
+    'reset': 1,             # sccReset of a set of cores
+    'boot': 60,             # sccBoot -l on all cores
+    'probe': 0.1,           # readiness probe sweep of the booting cores
+    'reinit': 30,           # sccBmc -i
+    'promote': 0.5,         # storing a checkpoint in the safe location
+    'restore': 1,           # restoring a checkpoint from the safe location
+    'sdc_detect': 0.5,      # from a corrupted output line to the SDC diagnostic failure
+    'exit_detect': 0.1,     # from a process exit to the processExit diagnostic failure
+    'core_detect': 3,       # from a core failure to the coreReachability diagnostic failure
+}
+
+
+class virtualClock(object):
+    ''' Replaces time() and sleep() in the depman modules '''
+
+    def __init__(self):
+        self.now = 0.0
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += max(seconds, 0)
+
+    def advance_to(self, t):
+        self.now = max(self.now, t)
+
+
+class boardModel(object):
+    ''' Model of the SCC board and its management tools. Cores in down recover
+        when they are reset, cores in dead never do
+    '''
+
+    def __init__(self, sim):
+        self.sim = sim
+        self.down = set()
+        self.dead = set()
+
+    def call(self, args, **kwargs):
+        ''' Replaces subprocess.call for the SCC tools and the kill script '''
+        clock, latency = self.sim.clock, self.sim.latencies
+        command = os.path.basename(args[0])
+        if command == 'sccReset':
+            clock.sleep(latency['reset'])
+            if args[1] == '-r':
+                self.down -= set('rck' + core for core in args[2:])
+        elif command == 'sccBoot':
+            clock.sleep(latency['boot'])
+        elif command == 'sccBmc':
+            clock.sleep(latency['reinit'])
+            self.down.clear()
+        elif args[0] == rccerun_path:
+            clock.sleep(latency['kill'])
+        return 0
+
+    def sweep(self, hosts, timeout):
+        ''' Replaces the readiness probe of wait_for_cores: the cores answer once booted '''
+        self.sim.clock.sleep(min(self.sim.latencies['probe'], timeout))
+        return set(hosts) - self.down - self.dead
+
+
+class constantPower(object):
+    ''' Board power model: a constant draw on the virtual clock, in place of the powerSampler '''
+
+    def __init__(self, sim, watts):
+        self.sim = sim
+        self.watts = watts
+
+    @property
+    def total_energy(self):
+        return self.watts * self.sim.clock.now
+
+    def energy(self, start, end):
+        return self.watts * (end - start)
+
+    def wait(self):
+        pass
+
+
+class virtualPlanner(countermeasurePlanner):
+    ''' Runs the steps of a plan one at a time, each one from the virtual time at which
+        the concurrent planner would start it, so that overlapping steps take no more
+        virtual time than the longest of them
+    '''
+
+    def __init__(self, sim, countermeasures):
+        countermeasurePlanner.__init__(self, countermeasures)
+        self.sim = sim
+
+    def run(self):
+        clock = self.sim.clock
+        t0 = finish = clock.now
+        pending = list(self.steps)
+        ends = {}       # key -> end of the succeeded steps
+        free = {}       # resource -> time it is released
+        lanes = []      # trace lane -> end of its last step
+        failure = None
+        while len(pending) > 0:
+            ready = [(max([t0] + [ends[key] for key in self.requires[k]] +
+                          [free.get(resource, t0) for resource in step.resources]), n, k, step)
+                     for n, (k, step) in enumerate(pending) if self.requires[k] <= set(ends)]
+            if len(ready) == 0:
+                break
+            start, n, key, step = min(ready)
+            if failure is not None and start >= failure:
+                break
+            pending.remove((key, step))
+            clock.now = start
+            ok = step.action()
+            end = clock.now
+            lane = min([i for i, busy in enumerate(lanes) if busy <= start] + [len(lanes)])
+            lanes[lane:lane + 1] = [end]
+            self.record(key, start, end, lane)
+            for resource in step.resources:
+                free[resource] = end
+            finish = max(finish, end)
+            if ok:
+                ends[key] = end
+            elif failure is None or end < failure:
+                failure = end
+        clock.now = finish
+        return failure is None and len(pending) == 0
+
+
+class stagerModel(object):
+    ''' Checkpoint staging model: a staging takes the restore latency from the time
+        it is requested, and restarts when the choice of checkpoint changes
+    '''
+
+    def __init__(self, sim):
+        self.sim = sim
+        self.wanted = None
+        self.ready = None
+
+    def stage(self, step, files):
+        if self.wanted != (step, files):
+            self.wanted = (step, files)
+            self.ready = self.sim.clock.now + self.sim.latencies['restore']
+
+    def swap(self, step, files, update=False):
+        if self.wanted != (step, files):
+            return False
+        self.sim.clock.advance_to(self.ready)
+        self.sim.restored_step = step
+        self.wanted = None
+        return True
+
+
+class nullStore(object):
+    ''' Checkpoint store model: only accounts for the promotion and restore latencies '''
+
+    def __init__(self, sim):
+        self.sim = sim
+        self.steps = set()
+
+    def contains(self, step, filename):
+        return step in self.steps
+
+    def promote(self, step, source_dir, files):
+        self.sim.clock.sleep(self.sim.latencies['promote'])
+        self.steps.add(step)
+        return True
+
+    def restore(self, step, dest_dir, files, update=False):
+        self.sim.clock.sleep(self.sim.latencies['restore'])
+        self.sim.restored_step = step
+        return True
+
+    def delete(self, step):
+        self.steps.discard(step)
+
+
+class simulatedRun(object):
+    ''' Model of an rccerun process: the application advances one step every
+        step_time seconds and stores a checkpoint of latency seconds every
+        interval_steps steps
+    '''
+    pid = None
+
+    def __init__(self, sim, start_step, interval_steps, step_time):
+        self.sim = sim
+        self.start = sim.clock.now + sim.latencies['startup']
+        self.start_step = start_step
+        self.interval_steps = max(interval_steps, 1)
+        self.step_time = step_time
+        self.killed = False
+        self.end = None
+
+    def _period(self):
+        return self.interval_steps * self.step_time + self.sim.checkpoint_latency
+
+    def progress(self, t):
+        ''' Returns the simulation step reached and the last checkpointed step at time t '''
+        elapsed = max(t - self.start, 0)
+        checkpoints = int(elapsed // self._period())
+        remainder = elapsed - checkpoints * self._period()
+        step = self.start_step + checkpoints * self.interval_steps + \
+               min(int(remainder / self.step_time), self.interval_steps)
+        last = self.start_step + checkpoints * self.interval_steps
+        return min(step, self.sim.total_steps), min(last, self.sim.total_steps)
+
+    def completion_time(self):
+        steps = self.sim.total_steps - self.start_step
+        checkpoints = max((steps - 1) // self.interval_steps, 0)
+        return self.start + steps * self.step_time + checkpoints * self.sim.checkpoint_latency
+
+    def kill(self):
+        if not self.killed:
+            self.killed = True
+            self.end = self.sim.clock.now
+
+    def wait(self):
+        ''' Advances the clock to the next failure or to the end of the simulation '''
+        if self.killed:
+            # no restart was performed: failures persist on the board
+            self.sim.detect_persistent_failures()
+            return 255
+
+        tracing.tracer.output_resumed('simulation', self.start)
+        failure = self.sim.next_failure(self.start)
+        done = self.completion_time()
+        if failure is not None and failure[0] < done:
+            self.sim.clock.advance_to(failure[0])
+            self.sim.fail(failure[1], failure[2], self)
+            return 255
+
+        self.sim.clock.advance_to(done)
+        self.end = done
+        self.sim.finished = True
+        self.sim.measure_checkpoints(self, done)
+        return 0
+
+
+class simulatedOutputDivergence(infoliOutputDivergence):
+    ''' SDC detector model with the real infoli countermeasure procedure '''
+
+    def __init__(self, manager):
+        self.manager = manager
+        self.injectors = []
+        self.corrupted_step = None
+        diagnostic.__init__(self)
+
+    def wait(self):
+        if self.corrupted_step is not None and len(self.manager.failed_diagnostics()) != 0:
+            self.manager.min_step = self.corrupted_step
+
+    def reinitialize(self):
+        self.corrupted_step = None
+
+    def completed(self):
+        return True
+
+    def progress(self):
+        return None
+
+
+class simulatedProcessExit(processExit):
+    ''' Process exit detector model with the real countermeasure procedure '''
+
+    def __init__(self, manager):
+        self.manager = manager
+        self.injectors = []
+        diagnostic.__init__(self)
+
+    def wait(self):
+        pass
+
+    def reinitialize(self):
+        pass
+
+
+class simulatedReachability(coreReachability):
+    ''' Core reachability detector model with the real countermeasure procedure
+        and degradation
+    '''
+
+    def __init__(self, manager):
+        self.manager = manager
+        self.injectors = []
+        self.unreachables = []
+        self.perm_unreachables = []
+        diagnostic.__init__(self)
+
+    def wait(self):
+        pass
+
+    def reinitialize(self):
+        self.unreachables = []
+
+
+class simulatedDepman(depman):
+    ''' depman running against the models of a simulator '''
+
+    def __init__(self, sim, cores, interval_steps, cells):
+        self.sim = sim
+        self.fault_injection = False
+        self.benchmarking = False
+        self.num_cores = len(cores)
+        self.hostfile = 'hostfile'
+        self.restart_exec = 'restart'
+        self.exec_list = ['infoli', str(interval_steps)]
+        self.moving_avg_N = moving_avg_N
+        self.initial_cores = cores[:]
+        self.cores = cores[:]
+        self.power = constantPower(sim, sim.power)
+        self.mttffd = open(os.devnull, 'w')
+        self.cells = cells
+        self.update_cellcount()
+        self.sim_dir = ''
+        self.store = nullStore(sim)
+        self.stager = stagerModel(sim)
+        self.catalog = checkpointCatalog(None)
+        self.allocations = allocationCache(seed=sim.seed)
+        self.init_policy_state()
+        self.min_step = sim.total_steps
+
+        self.rccerun(self.exec_list, True)
+        self.sdc = simulatedOutputDivergence(self)
+        self.exit = simulatedProcessExit(self)
+        self.reachability = simulatedReachability(self)
+        self.diagnostics = [self.exit, self.sdc, self.reachability]
+        self.failure_timestamp = sim.clock.time()
+
+    def create_hostfile(self, cores):
+        pass
+
+    def change_cores(self, cores):
+        self.cores = cores
+        self.update_cellcount()
+        self.num_cores = len(cores)
+
+    def rccerun(self, exec_list, pipe):
+        step_time = self.sim.step_time * len(self.initial_cores) / float(len(self.cores))
+        self.simulation = simulatedRun(self.sim, self.sim.restored_step, int(exec_list[-1]), step_time)
+        self.sim.runs.append(self.simulation)
+
+    def stop(self):
+        with self.lock:
+            self.timestamp = self.sim.clock.time()
+            self.stopped = True
+            self.simulation.kill()
+            self.sim.measure_checkpoints(self.simulation, self.timestamp)
+            self.sim.clock.sleep(self.sim.latencies['kill'])
+
+    def new_DUE_checkpoint(self):
+        ''' returns True if a new valid DUE checkpoint was found '''
+        step, globalmax = self.simulation.progress(self.simulation.end)
+        if globalmax <= self.prev_globalmax:
+            return False
+        self.prev_globalmax = globalmax
+        self.store.promote(globalmax, None, [])
+        self.checkpoints.append(globalmax)
+        return True
+
+
+class simulator(object):
+    ''' Runs depman on a virtual clock against a failure trace and reports
+        waste time, MTTR and goodput
+    '''
+
+    def __init__(self, trace, total_steps, interval_steps, step_time, checkpoint_latency,
+                 cores=48, cells=2304, latencies=None, horizon=1e9, seed=0, power=100):
+        self.clock = virtualClock()
+        self.board = boardModel(self)
+        self.trace = deque(sorted(trace))
+        self.total_steps = total_steps
+        self.interval_steps = interval_steps
+        self.step_time = step_time
+        self.checkpoint_latency = checkpoint_latency
+        self.core_names = ['rck' + str(i).zfill(2) for i in range(cores)]
+        self.cells = cells
+        self.latencies = dict(default_latencies)
+        self.latencies.update(latencies or {})
+        self.horizon = horizon
+        self.seed = seed
+        self.power = power
+        self.restored_step = 0
+        self.runs = []
+        self.failures = []
+        self.finished = False
+        self.recorded = set()   # runs whose checkpoint measurements were recorded
+
+    def next_failure(self, start):
+        ''' Pops the next failure of the trace. Failures that occurred while the
+            simulation was not running take effect when it starts
+        '''
+        if len(self.trace) == 0:
+            return None
+        t, kind, core = self.trace.popleft()
+        return max(t, start), kind, core
+
+    def fail(self, kind, core, run):
+        ''' Makes the diagnostic of a failure kind fail after its detection latency '''
+        dm = self.manager
+        if core is None:
+            core = random.choice(dm.cores)
+        self.failures.append((self.clock.now, kind, core))
+        if kind == 'sdc':
+            self.clock.sleep(self.latencies['sdc_detect'])
+            dm.sdc.corrupted_step = run.progress(self.clock.now - self.latencies['sdc_detect'])[0]
+            dm.sdc.fail()
+        elif kind == 'exit':
+            self.clock.sleep(self.latencies['exit_detect'])
+            dm.exit.fail()
+        elif kind in ('core', 'corefail'):
+            if kind == 'core':
+                self.board.down.add(core)
+            else:
+                self.board.dead.add(core)
+            self.clock.sleep(self.latencies['core_detect'])
+            dm.reachability.unreachables = [core]
+            dm.reachability.fail()
+        else:
+            raise ValueError("Unknown failure kind " + kind)
+
+    def detect_persistent_failures(self):
+        ''' Fails the reachability diagnostic if a core of the run is still unavailable '''
+        dm = self.manager
+        unavailable = [core for core in dm.cores if core in (self.board.down | self.board.dead)]
+        if len(unavailable) > 0:
+            self.clock.sleep(self.latencies['core_detect'])
+            dm.reachability.unreachables = unavailable
+            dm.reachability.fail()
+
+    def measure_checkpoints(self, run, t):
+        ''' Reports the interval and latency of the checkpoints of the first run, as the
+            checkpointMonitor does
+        '''
+        if run in self.recorded or self.manager.restarted:
+            return
+        self.recorded.add(run)
+        step, last = run.progress(t)
+        for i in range((last - run.start_step) // run.interval_steps):
+            self.manager.intervals.add(run._period())
+            self.manager.latencies.add(self.checkpoint_latency)
+
+    def _patch(self):
+        ''' Replaces the clock and the SCC tools in the depman modules '''
+        patches = [(depman_module, 'time', self.clock.time),
+                   (depman_module, 'sleep', self.clock.sleep),
+                   (depman_module, 'call', self.board.call),
+                   (scc_countermeasures, 'time', self.clock.time),
+                   (scc_countermeasures, 'sleep', self.clock.sleep),
+                   (scc_countermeasures, 'call', self.board.call),
+                   (scc_countermeasures, 'create_readiness_probe', lambda: self.board),
+                   (depman_module, 'countermeasurePlanner', lambda cms: virtualPlanner(self, cms)),
+                   (scc_countermeasures, 'countermeasurePlanner', lambda cms: virtualPlanner(self, cms)),
+                   (tracing.tracer, 'clock', self.clock.time)]
+        saved = [(module, name, getattr(module, name)) for module, name, value in patches]
+        for module, name, value in patches:
+            setattr(module, name, value)
+        return saved
+
+    def run(self):
+        ''' Runs depman until the simulation completes, cannot be recovered,
+            or the horizon is reached, and returns the report
+        '''
+        t0 = wall_time()
+        saved = self._patch()
+        recoverable = True
+        try:
+            self.manager = simulatedDepman(self, self.core_names, self.interval_steps, self.cells)
+            while not self.manager.completed and self.clock.now < self.horizon:
+                self.manager.event_loop()
+        except SystemExit:
+            recoverable = False
+        finally:
+            for module, name, value in saved:
+                setattr(module, name, value)
+        return self.report(recoverable, wall_time() - t0)
+
+    def report(self, recoverable, elapsed):
+        dm = self.manager
+        ideal = self.total_steps * self.step_time
+        total = self.clock.now
+        report = {
+            'completed': self.finished,
+            'recoverable': recoverable,
+            'virtual_time': total,
+            'wall_time': elapsed,
+            'speedup': total / max(elapsed, 1e-9),
+            'failures': len(self.failures),
+            'waste_time': total - ideal if self.finished else None,
+            'goodput': ideal / total if self.finished and total > 0 else None,
+            'mttr': sum(dm.mttr_values) / len(dm.mttr_values) if len(dm.mttr_values) > 0 else None,
+            'checkpoints': len(dm.checkpoints),
+            'interval_steps': int(dm.exec_list[-1]),
+            'cores': len(dm.cores),
+            'energy': dm.power.total_energy,
+        }
+        return report
+
+
+def read_trace(filename):
+    ''' Parses a failure trace file '''
+    trace = []
+    with open(filename, 'r') as f:
+        for line in f:
+            tokens = line.split('#')[0].split()
+            if len(tokens) == 0:
+                continue
+            core = tokens[2] if len(tokens) > 2 else None
+            trace.append((float(tokens[0]), tokens[1], core))
+    return trace
+
+
+def exponential_trace(mttf, kinds, horizon):
+    ''' Draws failure times from an exponential TTF with the given mean, with failure
+        kinds drawn uniformly from kinds
+    '''
+    trace = []
+    t = random.expovariate(1.0 / mttf)
+    while t < horizon:
+        trace.append((t, random.choice(kinds), None))
+        t += random.expovariate(1.0 / mttf)
+    return trace
+
+
+def main():
+    parser = OptionParser(usage="usage: %prog [options] [trace]")
+    parser.add_option('--steps', type='int', default=120000, help="simulation steps of the application")
+    parser.add_option('--interval', type='int', default=10000, help="initial checkpoint interval in steps")
+    parser.add_option('--step-time', type='float', default=0.01, help="time of one step on all cores")
+    parser.add_option('--latency', type='float', default=0.23, help="checkpoint latency")
+    parser.add_option('--cores', type='int', default=48)
+    parser.add_option('--mttf', type='float', help="draw exponential failures with this MTTF when no trace is given")
+    parser.add_option('--kinds', default='sdc,exit,core', help="failure kinds drawn with --mttf")
+    parser.add_option('--horizon', type='float', default=1e7, help="maximum virtual time")
+    parser.add_option('--model', action='append', default=[], metavar='NAME=SECONDS',
+                      help="override a model latency: " + ', '.join(sorted(default_latencies)))
+    parser.add_option('--power', type='float', default=100, help="board power draw in W")
+    parser.add_option('--seed', type='int', default=0)
+    parser.add_option('--trace', metavar='FILE', help="record the failure cycles as Chrome trace events")
+    parser.add_option('--verbose', action='store_true', help="keep the output of depman")
+    options, args = parser.parse_args()
+
+    random.seed(options.seed)
+    if len(args) > 0:
+        trace = read_trace(args[0])
+    elif options.mttf:
+        trace = exponential_trace(options.mttf, options.kinds.split(','), options.horizon)
+    else:
+        parser.error("a trace or --mttf is required")
+    latencies = {}
+    for model in options.model:
+        name, value = model.split('=')
+        if name not in default_latencies:
+            parser.error("unknown model latency " + name)
+        latencies[name] = float(value)
+
+    logging.basicConfig(level=logging.DEBUG if options.verbose else logging.CRITICAL)
+    sim = simulator(trace, options.steps, options.interval, options.step_time, options.latency,
+                    options.cores, latencies=latencies, horizon=options.horizon,
+                    seed=options.seed, power=options.power)
+    stdout = sys.stdout
+    if not options.verbose:
+        sys.stdout = open(os.devnull, 'w')
+    if options.trace:
+        tracing.tracer.open(options.trace)
+    try:
+        report = sim.run()
+    finally:
+        sys.stdout = stdout
+        tracing.tracer.close()
+    print json.dumps(report, indent=2, sort_keys=True)
+
+if __name__ == "__main__":
+    main()
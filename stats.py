@@ -0,0 +1,109 @@
+from math import sqrt
+
+from config import ewma_alpha
+
+class p2Quantile(object):
+    ''' Streaming estimate of the p-quantile in constant memory, through the P-square
+        algorithm of Jain and Chlamtac: five markers track the minimum, the p/2, p and
+        (1+p)/2 quantiles and the maximum, and are moved along piecewise-parabolic
+        interpolations as measures arrive
+    '''
+
+    def __init__(self, p):
+        self.p = p
+        self.heights = []       # marker heights, the first five measures until then
+        self.positions = [0, 1, 2, 3, 4]
+        self.desired = [0, 2 * p, 4 * p, 2 + 2 * p, 4]
+        self.increments = [0, p / 2, p, (1 + p) / 2, 1]
+
+    def add(self, x):
+        q = self.heights
+        if len(q) < 5:
+            q.append(x)
+            q.sort()
+            return
+
+        if x < q[0]:
+            q[0] = x
+            k = 0
+        elif x >= q[4]:
+            q[4] = x
+            k = 3
+        else:
+            k = 0
+            while x >= q[k + 1]:
+                k += 1
+        n = self.positions
+        for i in range(k + 1, 5):
+            n[i] += 1
+        for i in range(5):
+            self.desired[i] += self.increments[i]
+
+        for i in range(1, 4):
+            d = self.desired[i] - n[i]
+            if (d >= 1 and n[i + 1] - n[i] > 1) or (d <= -1 and n[i - 1] - n[i] < -1):
+                d = 1 if d > 0 else -1
+                parabolic = q[i] + float(d) / (n[i + 1] - n[i - 1]) * \
+                    ((n[i] - n[i - 1] + d) * (q[i + 1] - q[i]) / (n[i + 1] - n[i]) +
+                     (n[i + 1] - n[i] - d) * (q[i] - q[i - 1]) / (n[i] - n[i - 1]))
+                if q[i - 1] < parabolic < q[i + 1]:
+                    q[i] = parabolic
+                else:
+                    q[i] += d * (q[i + d] - q[i]) / float(n[i + d] - n[i])
+                n[i] += d
+
+    def value(self):
+        q = self.heights
+        if len(q) == 0:
+            return None
+        if len(q) < 5:
+            return q[min(int(self.p * len(q)), len(q) - 1)]
+        return q[2]
+
+
+class streamingStats(object):
+    ''' Constant-memory statistics of a stream of measures: mean and variance through
+        Welford's algorithm, an exponentially weighted moving average that follows
+        recent measures, and P-square estimates of the median, p95 and p99
+    '''
+
+    def __init__(self, alpha=ewma_alpha):
+        self.alpha = alpha
+        self.count = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.ewma = None
+        self.min = self.max = None
+        self.quantiles = {'p50': p2Quantile(0.5), 'p95': p2Quantile(0.95), 'p99': p2Quantile(0.99)}
+
+    def __len__(self):
+        return self.count
+
+    def add(self, x):
+        self.count += 1
+        delta = x - self.mean
+        self.mean += delta / self.count
+        self.m2 += delta * (x - self.mean)
+        self.ewma = x if self.ewma is None else self.alpha * x + (1 - self.alpha) * self.ewma
+        self.min = x if self.min is None else min(self.min, x)
+        self.max = x if self.max is None else max(self.max, x)
+        for quantile in self.quantiles.values():
+            quantile.add(x)
+
+    def variance(self):
+        return self.m2 / (self.count - 1) if self.count > 1 else 0.0
+
+    def stddev(self):
+        return sqrt(self.variance())
+
+    def get(self, statistic):
+        ''' Returns a statistic by name: mean, ewma, p50, p95, p99, min or max '''
+        if statistic in self.quantiles:
+            return self.quantiles[statistic].value()
+        elif statistic in ('mean', 'ewma', 'min', 'max'):
+            return getattr(self, statistic)
+        raise ValueError("Unknown statistic " + str(statistic))
+
+    def summary(self):
+        return "mean %f, stddev %f, ewma %f, p50 %f, p95 %f, p99 %f, max %f" % (self.mean,
+            self.stddev(), self.ewma, self.get('p50'), self.get('p95'), self.get('p99'), self.max)
@@ -0,0 +1,107 @@
+import logging
+from random import Random
+
+from core_allocator import allocate_tasks, scc_mesh
+from config import thermal_conductance, thermal_leakage, task_power, idle_power, thermal_candidates
+
+try:
+    import numpy
+except ImportError:
+    numpy = None    # placements fall back to the distance heuristic
+
+
+class thermalModel(object):
+    ''' Steady-state heat model of a mesh of cores. Every core exchanges heat with its
+        mesh neighbours through conductance and with the heatsink through leakage, so
+        the temperature rise over ambient is T = G P, where G is the inverse of the
+        conductance matrix (its Green's function) and P the power of every core.
+        G is computed once per model, and temperatures of many power maps are obtained
+        with a single matrix product
+    '''
+
+    def __init__(self, topology=scc_mesh, conductance=thermal_conductance, leakage=thermal_leakage):
+        self.topology = topology
+        rows, cols = topology.rows, topology.cols
+        n = rows * cols
+        K = numpy.zeros((n, n))
+        for x in range(rows):
+            for y in range(cols):
+                c = x * cols + y
+                K[c, c] += leakage
+                for nx, ny in ((x + 1, y), (x, y + 1)):
+                    if nx < rows and ny < cols:
+                        d = nx * cols + ny
+                        K[c, c] += conductance
+                        K[d, d] += conductance
+                        K[c, d] -= conductance
+                        K[d, c] -= conductance
+        self.green = numpy.linalg.inv(K)
+
+    def temperatures(self, powers):
+        ''' Returns the temperature rise of every core for each row of powers '''
+        return numpy.dot(powers, self.green.T)
+
+    def peak_temperatures(self, placements, task_power=task_power, idle_power=idle_power):
+        ''' Returns the predicted peak temperature rise of a list of placements, each
+            a list of cell indices running a task. The other cells are idle
+        '''
+        powers = numpy.empty((len(placements), self.green.shape[0]))
+        powers.fill(idle_power)
+        for i, cells in enumerate(placements):
+            powers[i, cells] = task_power
+        return self.temperatures(powers).max(axis=1)
+
+
+_models = {}   # topology name -> thermalModel
+
+def thermal_model(topology):
+    if topology.name not in _models:
+        _models[topology.name] = thermalModel(topology)
+    return _models[topology.name]
+
+
+def thermal_allocate(num_tasks, initial_cores, topology=scc_mesh, rng=None,
+                     candidates=thermal_candidates, task_power=task_power, idle_power=idle_power):
+    ''' Allocates num_tasks jobs on the placement of lowest predicted peak temperature.
+        Candidates are drawn from the distance heuristic with different tie-breaking,
+        and from moves of one task of these onto a free core. The first candidate is
+        the heuristic placement itself, which is returned without numpy
+    '''
+    rng = rng or Random()
+    best = allocate_tasks(num_tasks, initial_cores, topology, rng)
+    if numpy is None or num_tasks == 0:
+        return best
+
+    cols = topology.cols
+    def cell(core):
+        x, y = topology.coords_from_name(core)
+        return x * cols + y
+
+    available = [cell(core) for core in initial_cores]
+    seen = set()
+    placements = []
+    def add(cells):
+        key = tuple(sorted(cells))
+        if key not in seen:
+            seen.add(key)
+            placements.append(list(key))
+
+    add([cell(core) for core in best])
+    for i in range(candidates // 4):
+        add([cell(core) for core in allocate_tasks(num_tasks, initial_cores, topology, rng)])
+    heuristic = list(placements)
+    for i in range(candidates * 4):
+        if len(placements) >= candidates:
+            break
+        cells = list(rng.choice(heuristic))
+        free = [c for c in available if c not in cells]
+        if len(free) == 0:
+            break
+        cells[rng.randrange(len(cells))] = rng.choice(free)
+        add(cells)
+
+    peaks = thermal_model(topology).peak_temperatures(placements, task_power, idle_power)
+    chosen = int(peaks.argmin())
+    logging.debug("Thermal placement: peak rise %.3f over %d candidates, %.3f for the heuristic",
+                  peaks[chosen], len(placements), peaks[0])
+    return [topology.name_from_coords(*divmod(c, cols)) for c in placements[chosen]]
@@ -0,0 +1,114 @@
+import json
+import logging
+from time import time
+from threading import Lock
+from contextlib import contextmanager
+
+RECOVERY, FAULTS, STEPS = 1, 2, 3     # trace viewer lanes, concurrent steps use STEPS and above
+
+
+class traceRecorder(object):
+    ''' Records every failure cycle as a span tree in the Chrome trace event format,
+        which chrome://tracing and Perfetto open. A cycle starts when the first
+        diagnostic fails and ends at the first output line after the restart, and
+        contains the spans of the recovery stages. Events are streamed to the trace
+        file as a JSON array, so that the trace of an interrupted run can still be
+        opened. Nothing is recorded until a trace file is opened
+    '''
+
+    def __init__(self):
+        self.out = None
+        self.clock = time
+        self.lock = Lock()
+        self.cycles = 0
+        self.cycle_start = None     # start of the open failure cycle
+        self.repaired = None        # end of the repair of the open failure cycle
+        self.awaiting_output = False
+
+    def open(self, filename):
+        try:
+            self.out = open(filename, 'w')
+        except IOError as e:
+            logging.warning("Trace file %s could not be opened: %s", filename, e)
+            return
+        self.out.write('[\n')
+        self._emit({'name': 'process_name', 'ph': 'M', 'pid': 1, 'args': {'name': 'depman'}})
+        for tid, name in ((RECOVERY, 'recovery'), (FAULTS, 'faults'), (STEPS, 'steps')):
+            self._emit({'name': 'thread_name', 'ph': 'M', 'pid': 1, 'tid': tid, 'args': {'name': name}})
+
+    def close(self):
+        with self.lock:
+            if self.cycle_start is not None:
+                self._close_cycle(self.repaired or self.clock())
+            if self.out is not None:
+                self.out.close()
+                self.out = None
+
+    def _emit(self, event):
+        if self.out is None:
+            return
+        self.out.write(json.dumps(event) + ',\n')
+        self.out.flush()
+
+    def instant(self, name, tid=RECOVERY, t=None, **args):
+        with self.lock:
+            self._emit({'name': name, 'ph': 'i', 's': 't', 'pid': 1, 'tid': tid,
+                        'ts': int((t or self.clock()) * 1e6), 'args': args})
+
+    def complete(self, name, start, end, tid=RECOVERY, **args):
+        with self.lock:
+            self._emit({'name': name, 'ph': 'X', 'pid': 1, 'tid': tid, 'ts': int(start * 1e6),
+                        'dur': int((end - start) * 1e6), 'args': args})
+
+    @contextmanager
+    def span(self, name, **args):
+        ''' Records the duration of a with block '''
+        start = self.clock()
+        try:
+            yield
+        finally:
+            self.complete(name, start, self.clock(), **args)
+
+    def fault(self, name):
+        ''' Records an injected fault '''
+        self.instant(name, tid=FAULTS)
+
+    def failure_detected(self, diagnostic):
+        ''' Opens a failure cycle on the first failed diagnostic '''
+        now = self.clock()
+        with self.lock:
+            if self.awaiting_output:
+                self._close_cycle(self.repaired)    # failed again before any output
+            if self.cycle_start is None:
+                self.cycles += 1
+                self.cycle_start = now
+        self.instant(diagnostic + ' failed', t=now)
+
+    def repair_completed(self):
+        ''' Marks the end of the repair, the cycle ends at the first output line '''
+        with self.lock:
+            if self.cycle_start is not None:
+                self.repaired = self.clock()
+                self.awaiting_output = True
+
+    def output_resumed(self, source, t=None):
+        ''' Closes the open failure cycle at the first output line after a restart '''
+        if not self.awaiting_output:
+            return
+        t = t or self.clock()
+        with self.lock:
+            if not self.awaiting_output:
+                return
+            self._emit({'name': 'first output', 'ph': 'i', 's': 't', 'pid': 1, 'tid': RECOVERY,
+                        'ts': int(t * 1e6), 'args': {'source': source}})
+            self._close_cycle(t)
+
+    def _close_cycle(self, end):
+        self._emit({'name': 'failure cycle %d' % self.cycles, 'ph': 'X', 'pid': 1, 'tid': RECOVERY,
+                    'ts': int(self.cycle_start * 1e6), 'dur': int((end - self.cycle_start) * 1e6),
+                    'args': {'repair': self.repaired and self.repaired - self.cycle_start}})
+        self.cycle_start = self.repaired = None
+        self.awaiting_output = False
+
+''' The recorder of the depman modules '''
+tracer = traceRecorder()